@@ -0,0 +1,120 @@
+"""Compare single-pass upgrade classification with the original four-pass filter.
+
+    python benchmarks/bench_classify.py --rows 100000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pywingetupgrader  # noqa: E402
+from bench_parse import LEGACY_SEMVER_PATTERN, legacy_add_semver_details  # noqa: E402
+from synthetic import make_packages  # noqa: E402
+
+
+def legacy_get_applications_using_semver(applications):
+    return [
+        legacy_add_semver_details(app)
+        for app
+        in applications
+        if LEGACY_SEMVER_PATTERN.match(app["Version"]) or LEGACY_SEMVER_PATTERN.match(app["Available"])
+    ]
+
+
+def legacy_get_apps_to_upgrade(applications, upgrade_level, upgrade_unknowns):
+    applications_using_semver = legacy_get_applications_using_semver(applications)
+
+    apps_to_upgrade = []
+
+    if upgrade_level.lower() == "all":
+        return applications
+
+    apps_with_patch_upgrades = [
+        app
+        for app
+        in applications_using_semver
+        if "current_major" in app and "available_major" in app and app["current_major"] == app["available_major"] and app["current_minor"] == app["available_minor"] and app["current_patch"] < app["available_patch"]
+    ]
+    apps_with_minor_upgrades = [
+        app
+        for app
+        in applications_using_semver
+        if "current_major" in app and "available_major" in app and app["current_major"] == app["available_major"] and app["current_minor"] < app["available_minor"]
+    ]
+    apps_with_major_upgrades = [
+        app
+        for app
+        in applications_using_semver
+        if "current_major" in app and "available_major" in app and app["current_major"] < app["available_major"]
+    ]
+    apps_with_unknown_current_version = [
+        app
+        for app
+        in applications_using_semver
+        if app["Version"].lower() == "unknown"
+    ]
+
+    if upgrade_level == "patch":
+        apps_to_upgrade = apps_with_patch_upgrades
+    elif upgrade_level == "minor":
+        apps_to_upgrade = apps_with_minor_upgrades + apps_with_patch_upgrades
+    elif upgrade_level == "major":
+        apps_to_upgrade = apps_with_major_upgrades + apps_with_minor_upgrades + apps_with_patch_upgrades
+
+    if upgrade_unknowns:
+        apps_to_upgrade += apps_with_unknown_current_version
+
+    return apps_to_upgrade
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    packages = make_packages(args.rows)
+    legacy_apps = [
+        dict(zip(pywingetupgrader.APPLICATION_COLUMNS, package))
+        for package
+        in packages
+    ]
+    apps = pywingetupgrader.get_applications_with_comparable_versions(
+        pywingetupgrader.Application(*package)
+        for package
+        in packages
+    )
+    levels = ("patch", "minor", "major")
+
+    def legacy():
+        # The original recomputes every bucket for each upgrade level queried
+        for level in levels:
+            legacy_get_apps_to_upgrade(legacy_apps, level, True)
+
+    def single_pass():
+        classification = pywingetupgrader.UpgradeClassification(apps)
+        for level in levels:
+            classification.select(level, True)
+
+    # The legacy implementation only understands strict X.Y.Z versions, so the selections
+    # should agree on those apps
+    def is_legacy_semver(app):
+        return LEGACY_SEMVER_PATTERN.match(app.available) and (
+            LEGACY_SEMVER_PATTERN.match(app.version) or app.version.lower() == "unknown"
+        )
+
+    for level in levels:
+        assert (
+            [app["Id"] for app in legacy_get_apps_to_upgrade(legacy_apps, level, True)]
+            == [app.id for app in pywingetupgrader.get_apps_to_upgrade(apps, level, True) if is_legacy_semver(app)]
+        )
+
+    for name, run in (("legacy", legacy), ("single pass", single_pass)):
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        print(f"{name:>12}: {best * 1000:8.2f} ms to select {len(levels)} upgrade levels from {args.rows} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""End-to-end benchmark of main() against the fake winget.
+
+    python benchmarks/bench_end_to_end.py --packages 10 100 1000 --workers 4
+
+For each package count this reports the wall time of a full main() run, the time to
+list upgrades through winget (including process startup, see --startup-latency), the
+time to parse the upgrade listing, the upgrade throughput of upgrade_apps(),
+upgrade_apps_in_batch() and upgrade_apps_with_prefetch() with the time batching and
+prefetching save, and the number of winget processes started by main().
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+
+import pywingetupgrader  # noqa: E402
+
+FAKE_WINGET_PATH = os.path.join(BENCHMARKS_DIR, "fake_winget.py")
+
+
+def count_lines(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+
+def run_benchmark(package_count, workers, download_workers, environ):
+    with tempfile.TemporaryDirectory() as state_dir:
+        call_log_path = os.path.join(state_dir, "calls.jsonl")
+        os.environ.pop("FAKE_WINGET_STATE", None)
+        os.environ.update(environ)
+        os.environ.update({
+            "WINGET_EXE_PATH": FAKE_WINGET_PATH,
+            "WINGET_STATE_DIR": state_dir,
+            "WINGET_UPGRADE_LEVEL": "all",
+            "WINGET_MAX_WORKERS": str(workers),
+            "FAKE_WINGET_PACKAGES": str(package_count),
+            "FAKE_WINGET_CALL_LOG": call_log_path,
+        })
+
+        start = time.perf_counter()
+        pywingetupgrader.main()
+        wall_time = time.perf_counter() - start
+        winget_launches = count_lines(call_log_path)
+
+        start = time.perf_counter()
+        list(pywingetupgrader.get_applications_available_to_upgrade(FAKE_WINGET_PATH))
+        listing_time = time.perf_counter() - start
+
+        output = subprocess.run([FAKE_WINGET_PATH, "upgrade"], capture_output=True, check=True).stdout.decode("utf-8")
+        start = time.perf_counter()
+        applications = pywingetupgrader.extract_applications_from_table(output)
+        parse_time = time.perf_counter() - start
+
+        # Each upgrade path gets its own fake winget state so both start with every package outdated
+        os.environ["FAKE_WINGET_STATE"] = os.path.join(state_dir, "per-id-upgraded")
+        start = time.perf_counter()
+        pywingetupgrader.upgrade_apps(applications, FAKE_WINGET_PATH, workers)
+        upgrade_time = time.perf_counter() - start
+
+        os.environ["FAKE_WINGET_STATE"] = os.path.join(state_dir, "batch-upgraded")
+        start = time.perf_counter()
+        pywingetupgrader.upgrade_apps_in_batch(applications, FAKE_WINGET_PATH, workers)
+        batch_upgrade_time = time.perf_counter() - start
+
+        os.environ["FAKE_WINGET_STATE"] = os.path.join(state_dir, "prefetch-upgraded")
+        start = time.perf_counter()
+        pywingetupgrader.upgrade_apps_with_prefetch(
+            applications, FAKE_WINGET_PATH, os.path.join(state_dir, "downloads"), workers, download_workers
+        )
+        prefetch_upgrade_time = time.perf_counter() - start
+
+    print(
+        f"{package_count:>6} packages: "
+        f"main() {wall_time:8.3f} s, "
+        f"listing {listing_time:7.3f} s, "
+        f"parse {parse_time * 1000:8.2f} ms, "
+        f"upgrades {len(applications) / upgrade_time:8.1f}/s, "
+        f"batched {len(applications) / batch_upgrade_time:8.1f}/s "
+        f"(saves {upgrade_time - batch_upgrade_time:7.3f} s), "
+        f"prefetched {len(applications) / prefetch_upgrade_time:8.1f}/s "
+        f"(saves {upgrade_time - prefetch_upgrade_time:7.3f} s), "
+        f"{winget_launches} winget launches"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--startup-latency", type=float, default=0.0, help="seconds each winget launch takes")
+    parser.add_argument("--batch", action="store_true", help="run main() with WINGET_BATCH_UPGRADES set")
+    parser.add_argument("--prefetch", action="store_true", help="run main() with WINGET_PREFETCH set")
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--upgrade-latency", type=float, default=0.0, help="seconds each upgrade takes")
+    parser.add_argument("--download-latency", type=float, default=0.0, help="seconds each installer download takes")
+    args = parser.parse_args()
+
+    # Configured before main() so its own basicConfig call doesn't flood the output
+    logging.basicConfig(level=logging.WARNING)
+
+    environ = {
+        "FAKE_WINGET_STARTUP_LATENCY": str(args.startup_latency),
+        "FAKE_WINGET_UPGRADE_LATENCY": str(args.upgrade_latency),
+        "FAKE_WINGET_DOWNLOAD_LATENCY": str(args.download_latency),
+        "WINGET_BATCH_UPGRADES": str(args.batch),
+        "WINGET_PREFETCH": str(args.prefetch),
+        "WINGET_DOWNLOAD_WORKERS": str(args.download_workers),
+    }
+    for package_count in args.packages:
+        run_benchmark(package_count, args.workers, args.download_workers, environ)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Compare listing upgrades through "winget upgrade" with reading the source index database.
+
+    python benchmarks/bench_listing.py --packages 1000 --startup-latency 0.5
+
+Both backends run against the fake winget and a synthetic index, so the difference shows
+the cost of table scraping and winget's upgrade checks that the index backend skips. The
+index backend still runs "winget export" unless nothing was installed since its last run,
+which is measured separately by pretending the installed programs haven't changed.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+
+import pywingetupgrader  # noqa: E402
+from synthetic import make_packages, make_source_index  # noqa: E402
+
+FAKE_WINGET_PATH = os.path.join(BENCHMARKS_DIR, "fake_winget.py")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packages", type=int, default=1000)
+    parser.add_argument("--schema", type=int, choices=(1, 2), default=2)
+    parser.add_argument("--startup-latency", type=float, default=0.0, help="seconds each winget launch takes")
+    parser.add_argument("--row-latency", type=float, default=0.0, help="seconds winget takes to write each table row")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ.update({
+        "FAKE_WINGET_PACKAGES": str(args.packages),
+        "FAKE_WINGET_STARTUP_LATENCY": str(args.startup_latency),
+        "FAKE_WINGET_ROW_LATENCY": str(args.row_latency),
+    })
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        index_db_path = os.path.join(temporary_dir, "index.db")
+        make_source_index(index_db_path, make_packages(args.packages), args.schema)
+
+        inventory_cache_path = os.path.join(temporary_dir, "installed-packages.json")
+        # The registry can't be read off Windows, so the installed programs never change
+        pywingetupgrader.get_installed_programs_stamp = lambda: "unchanged"
+        candidates = (
+            ("table", None, None),
+            ("index", index_db_path, None),
+            # The first run fills the cache the second reads
+            ("index, first run", index_db_path, inventory_cache_path),
+            ("index, unchanged", index_db_path, inventory_cache_path),
+        )
+        for name, index, cache_path in candidates:
+            start = time.perf_counter()
+            applications = list(pywingetupgrader.get_applications_available_to_upgrade(
+                FAKE_WINGET_PATH,
+                index_db_path=index,
+                inventory_cache_path=cache_path,
+            ))
+            elapsed = time.perf_counter() - start
+            print(f"{name:>16}: {elapsed * 1000:9.2f} ms to list {len(applications)} upgrades")
+
+
+if __name__ == "__main__":
+    main()
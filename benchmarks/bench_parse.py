@@ -0,0 +1,85 @@
+"""Compare the precompiled column slicer with the original table parser.
+
+    python benchmarks/bench_parse.py --rows 10000
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pywingetupgrader  # noqa: E402
+from synthetic import make_upgrade_table  # noqa: E402
+
+LEGACY_SEMVER_PATTERN = re.compile(r"^\d+?\.\d+?\.\d+$")
+
+
+def legacy_extract_applications_from_table(output):
+    rows = output.split("\r\n")[:-2]
+    headers_and_their_starting_positions = pywingetupgrader.get_headers_and_their_starting_positions(rows)
+
+    records = []
+    for row in rows[2:]:
+        record = {}
+        for i, (key, start_pos) in enumerate(headers_and_their_starting_positions):
+            if i < len(headers_and_their_starting_positions) - 1:
+                _, end_pos = headers_and_their_starting_positions[i+1]
+                record[key] = row[start_pos:end_pos].strip()
+            else:
+                record[key] = row[start_pos:].strip()
+        records.append(record)
+
+    return records
+
+
+def legacy_add_semver_details(app):
+    if LEGACY_SEMVER_PATTERN.match(app["Version"]):
+        major, minor, patch = app["Version"].split(".")
+        app["current_major"] = int(major)
+        app["current_minor"] = int(minor)
+        app["current_patch"] = int(patch)
+    if LEGACY_SEMVER_PATTERN.match(app["Available"]):
+        available_major, available_minor, available_patch = app["Available"].split(".")
+        app["available_major"] = int(available_major)
+        app["available_minor"] = int(available_minor)
+        app["available_patch"] = int(available_patch)
+    return app
+
+
+def legacy_parse_with_versions(output):
+    return [legacy_add_semver_details(app) for app in legacy_extract_applications_from_table(output)]
+
+
+def parse_with_versions(output):
+    # Applications parse their versions when first read, which classification does. Each
+    # run starts with no versions memoized, so neither does each repetition
+    pywingetupgrader.parse_version.cache_clear()
+    applications = pywingetupgrader.extract_applications_from_table(output)
+    for app in applications:
+        app.parsed_version, app.parsed_available
+    return applications
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    table = make_upgrade_table(args.rows)
+
+    candidates = {
+        "legacy": legacy_extract_applications_from_table,
+        "legacy + semver": legacy_parse_with_versions,
+        "column slicer": pywingetupgrader.extract_applications_from_table,
+        "column slicer + versions": parse_with_versions,
+    }
+    for name, parse in candidates.items():
+        best = min(timeit.repeat(lambda: parse(table), number=1, repeat=args.repeat))
+        print(f"{name:>24}: {best * 1000:8.2f} ms for {args.rows} rows ({best / args.rows * 1e6:.2f} us/row)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""A stand-in for winget.exe that runs anywhere Python does.
+
+Point WINGET_EXE_PATH at this file to run pywingetupgrader without Windows. It is
+configured with environment variables:
+
+- FAKE_WINGET_PACKAGES, default=10, the number of packages with upgrades available.
+- FAKE_WINGET_SEED, default=0, seeds the versions generated for those packages.
+- FAKE_WINGET_STARTUP_LATENCY, default=0, seconds slept every time the fake is launched.
+- FAKE_WINGET_ROW_LATENCY, default=0, seconds slept before writing each row of a table.
+- FAKE_WINGET_UPGRADE_LATENCY, default=0, seconds an upgrade takes.
+- FAKE_WINGET_DOWNLOAD_LATENCY, default=0, seconds downloading an installer takes, both
+  when downloading it and before installing it in an upgrade or import.
+- FAKE_WINGET_CONFIG, default unset, path to a JSON file overriding behaviour per package id:
+  {"packages": {"<id>": {"latency": 5, "download_latency": 2, "exit_code": 1, "hang": true,
+  "installer_type": "msix", "corrupt": true, "success_codes": [3010]}}}. A package that hangs sleeps long enough for
+  the caller's timeout to expire. Downloaded installers are Python scripts installing the
+  package the way an upgrade would, with the "exe" installer type unless configured
+  otherwise. A corrupt package's downloaded installer doesn't match the SHA256 shown for it.
+  A package's success codes are listed as InstallerSuccessCodes in its downloaded manifest,
+  and it is upgraded when it exits with one of them.
+- FAKE_WINGET_STATE, default unset, path to a file that successfully upgraded package ids
+  are appended to. Packages in it are no longer listed as having upgrades available.
+- FAKE_WINGET_CALL_LOG, default unset, path to a file that every call is appended to as a
+  JSON line holding its arguments and start and end times.
+"""
+import hashlib
+import json
+import os
+import stat
+import sys
+import time
+
+from synthetic import HEADERS, format_row, make_export_file, make_packages
+
+FAKE_WINGET_VERSION = "v1.21.3482"
+# Exit code winget uses when no installed package matches the query
+NO_APPLICABLE_UPGRADE = 43
+# Exit code winget uses when one or more packages in an import file failed to install
+IMPORT_INSTALL_FAILED = 29
+
+
+def get_config():
+    config_path = os.environ.get("FAKE_WINGET_CONFIG")
+    if not config_path:
+        return {}
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f).get("packages", {})
+
+
+def get_packages():
+    return make_packages(
+        int(os.environ.get("FAKE_WINGET_PACKAGES", 10)),
+        int(os.environ.get("FAKE_WINGET_SEED", 0)),
+    )
+
+
+def get_upgraded_ids():
+    state_path = os.environ.get("FAKE_WINGET_STATE")
+    if not state_path or not os.path.exists(state_path):
+        return set()
+    with open(state_path, encoding="utf-8") as f:
+        return set(f.read().split())
+
+
+def record_upgraded(package_id):
+    state_path = os.environ.get("FAKE_WINGET_STATE")
+    if state_path:
+        with open(state_path, "a", encoding="utf-8") as f:
+            f.write(package_id + "\n")
+
+
+def download_package(package_id):
+    package_config = get_config().get(package_id, {})
+    time.sleep(package_config.get("download_latency", float(os.environ.get("FAKE_WINGET_DOWNLOAD_LATENCY", 0))))
+
+
+def install_package(package_id):
+    """Simulate installing package_id, returning the installer's exit code."""
+    package_config = get_config().get(package_id, {})
+    if package_config.get("hang"):
+        time.sleep(24 * 60 * 60)
+    time.sleep(package_config.get("latency", float(os.environ.get("FAKE_WINGET_UPGRADE_LATENCY", 0))))
+
+    exit_code = package_config.get("exit_code", 0)
+    if exit_code == 0 or exit_code in package_config.get("success_codes", ()):
+        record_upgraded(package_id)
+        write_rows(["Found " + package_id, "Successfully installed"])
+    else:
+        write_rows(["Found " + package_id, f"Installer failed with exit code: {exit_code}"])
+    return exit_code
+
+
+def get_option(args, name):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return None
+
+
+def write_rows(rows):
+    row_latency = float(os.environ.get("FAKE_WINGET_ROW_LATENCY", 0))
+    for row in rows:
+        if row_latency:
+            time.sleep(row_latency)
+        sys.stdout.buffer.write(row.encode("utf-8") + b"\r\n")
+        sys.stdout.buffer.flush()
+
+
+def write_table(packages, summary):
+    header = format_row(HEADERS)
+    rows = [
+        # winget draws a spinner before the header
+        "\r   - \r   \\ \r     \r" + header,
+        "-" * len(header),
+    ]
+    rows.extend(format_row(package) for package in packages)
+    rows.append(summary)
+    write_rows(rows)
+
+
+def list_command(args):
+    packages = get_packages()
+    count = get_option(args, "-n")
+    if count is not None:
+        packages = packages[:int(count)]
+    write_table(packages, "")
+    return 0
+
+
+def upgrade_command(args):
+    package_id = get_option(args, "--id")
+    upgraded_ids = get_upgraded_ids()
+    packages = [package for package in get_packages() if package[1] not in upgraded_ids]
+    if package_id is None:
+        write_table(packages, f"{len(packages)} upgrades available.")
+        return 0
+
+    if package_id not in {package[1] for package in packages}:
+        write_rows(["No installed package found matching input criteria."])
+        return NO_APPLICABLE_UPGRADE
+
+    download_package(package_id)
+    return install_package(package_id)
+
+
+def import_command(args):
+    with open(get_option(args, "--import-file"), encoding="utf-8") as f:
+        import_file = json.load(f)
+
+    upgraded_ids = get_upgraded_ids()
+    available_ids = {package[1] for package in get_packages()} - upgraded_ids
+    exit_code = 0
+    for source in import_file["Sources"]:
+        for package in source["Packages"]:
+            package_id = package["PackageIdentifier"]
+            if package_id not in available_ids:
+                write_rows([f"Package is already installed: {package_id}"])
+                continue
+            download_package(package_id)
+            if install_package(package_id) != 0:
+                exit_code = IMPORT_INSTALL_FAILED
+    return exit_code
+
+
+def export_command(args):
+    upgraded_ids = get_upgraded_ids()
+    packages = [
+        # Upgraded packages are installed at their available version
+        (name, package_id, available if package_id in upgraded_ids else version, available, source)
+        for name, package_id, version, available, source
+        in get_packages()
+    ]
+    with open(get_option(args, "--output"), "w", encoding="utf-8") as f:
+        json.dump(make_export_file(packages), f)
+    return 0
+
+
+# Run with the interpreter running the fake, so the installers work without a .py association
+INSTALLER_TEMPLATE = """#!{python}
+import sys
+sys.path.insert(0, {benchmarks_dir!r})
+import fake_winget
+sys.exit(fake_winget.install_package({package_id!r}))
+"""
+
+MANIFEST_TEMPLATE = """# Created using the fake winget
+PackageIdentifier: {package_id}
+PackageVersion: {version}
+Installers:
+- Architecture: x64
+  InstallerType: {installer_type}
+  InstallerSha256: {sha256}
+  InstallerSwitches:
+    Silent: /S
+{success_codes}ManifestType: singleton
+ManifestVersion: 1.6.0
+"""
+
+
+def format_success_codes(success_codes):
+    if not success_codes:
+        return ""
+    return "  InstallerSuccessCodes:\n" + "".join(f"  - {code}\n" for code in success_codes)
+
+
+def make_installer(package_id):
+    return INSTALLER_TEMPLATE.format(
+        python=sys.executable,
+        benchmarks_dir=os.path.dirname(os.path.abspath(__file__)),
+        package_id=package_id,
+    ).encode("utf-8")
+
+
+def download_command(args):
+    package_id = get_option(args, "--id")
+    packages_by_id = {package[1]: package for package in get_packages()}
+    if package_id not in packages_by_id:
+        write_rows(["No package found matching input criteria."])
+        return NO_APPLICABLE_UPGRADE
+
+    download_package(package_id)
+    version = get_option(args, "--version") or packages_by_id[package_id][3]
+    installer_type = get_config().get(package_id, {}).get("installer_type", "exe")
+    download_dir = get_option(args, "--download-directory")
+    os.makedirs(download_dir, exist_ok=True)
+    file_name = f"{package_id}_{version}_Machine_X64_{installer_type}_en-US"
+
+    installer = make_installer(package_id)
+    sha256 = hashlib.sha256(installer).hexdigest().upper()
+    if get_config().get(package_id, {}).get("corrupt"):
+        installer += b"# corrupted\n"
+
+    installer_path = os.path.join(download_dir, file_name + ".exe")
+    with open(installer_path, "wb") as f:
+        f.write(installer)
+    os.chmod(installer_path, os.stat(installer_path).st_mode | stat.S_IXUSR)
+    with open(os.path.join(download_dir, file_name + ".yaml"), "w", encoding="utf-8") as f:
+        f.write(MANIFEST_TEMPLATE.format(
+            package_id=package_id, version=version, installer_type=installer_type, sha256=sha256,
+            success_codes=format_success_codes(get_config().get(package_id, {}).get("success_codes")),
+        ))
+    write_rows(["Found " + package_id, "Installer downloaded: " + installer_path])
+    return 0
+
+
+def show_command(args):
+    package_id = get_option(args, "--id")
+    packages_by_id = {package[1]: package for package in get_packages()}
+    if package_id not in packages_by_id:
+        write_rows(["No package found matching input criteria."])
+        return NO_APPLICABLE_UPGRADE
+
+    name, _, _, available, _ = packages_by_id[package_id]
+    write_rows([
+        f"Found {name} [{package_id}]",
+        "Version: " + (get_option(args, "--version") or available),
+        "Publisher: " + package_id.split(".")[0],
+        "Installer:",
+        "  Installer Type: " + get_config().get(package_id, {}).get("installer_type", "exe"),
+        f"  Installer Url: https://example.com/{package_id}.exe",
+        "  Installer SHA256: " + hashlib.sha256(make_installer(package_id)).hexdigest().upper(),
+    ])
+    return 0
+
+
+COMMANDS = {
+    "list": list_command,
+    "upgrade": upgrade_command,
+    "import": import_command,
+    "export": export_command,
+    "download": download_command,
+    "show": show_command,
+}
+
+
+def main(args):
+    start = time.time()
+    time.sleep(float(os.environ.get("FAKE_WINGET_STARTUP_LATENCY", 0)))
+
+    if args[:1] == ["--version"]:
+        write_rows([FAKE_WINGET_VERSION])
+        exit_code = 0
+    elif args and args[0] in COMMANDS:
+        exit_code = COMMANDS[args[0]](args[1:])
+    else:
+        write_rows([f"Unrecognized command: '{' '.join(args)}'"])
+        exit_code = 1
+
+    call_log_path = os.environ.get("FAKE_WINGET_CALL_LOG")
+    if call_log_path:
+        with open(call_log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"args": args, "start": start, "end": time.time(), "exit_code": exit_code}) + "\n")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
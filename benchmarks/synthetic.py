@@ -0,0 +1,114 @@
+"""Synthetic winget data shared by the benchmarks."""
+import random
+import sqlite3
+
+HEADERS = ("Name", "Id", "Version", "Available", "Source")
+COLUMN_WIDTHS = (40, 40, 18, 18, 8)
+
+
+def make_packages(count, seed=0):
+    """Return (name, id, version, available, source) tuples with a realistic mix of versions."""
+    rng = random.Random(seed)
+    packages = []
+    for i in range(count):
+        major, minor, patch = rng.randint(0, 30), rng.randint(0, 20), rng.randint(0, 50)
+        kind = rng.random()
+        if kind < 0.4:
+            version, available = f"{major}.{minor}.{patch}", f"{major}.{minor}.{patch + 1}"
+        elif kind < 0.6:
+            version, available = f"{major}.{minor}.{patch}", f"{major}.{minor + 1}.0"
+        elif kind < 0.7:
+            version, available = f"{major}.{minor}.{patch}", f"{major + 1}.0.0"
+        elif kind < 0.9:
+            build = rng.randint(0, 9999)
+            version, available = f"{major}.{minor}.{patch}.{build}", f"{major}.{minor}.{patch}.{build + 1}"
+        elif kind < 0.95:
+            version, available = "Unknown", f"{major}.{minor}.{patch}"
+        else:
+            version, available = f"< {major}.{minor}", f"{2000 + major}.{minor}"
+        packages.append((f"Package {i}", f"Vendor{i % 97}.Package{i}", version, available, "winget"))
+    return packages
+
+
+def format_row(values):
+    return "".join(
+        value.ljust(width)
+        for value, width
+        in zip(values, COLUMN_WIDTHS)
+    ).rstrip()
+
+
+def make_upgrade_table(count, seed=0):
+    """Return "winget upgrade" style output listing count packages."""
+    header = format_row(HEADERS)
+    rows = [
+        # winget draws a spinner before the header
+        "\r   - \r   \\ \r     \r" + header,
+        "-" * len(header),
+    ]
+    rows.extend(format_row(package) for package in make_packages(count, seed))
+    rows.append(f"{count} upgrades available.")
+    rows.append("")
+    return "\r\n".join(rows)
+
+
+def make_source_index(path, packages, schema=2):
+    """Write a winget source index database at path holding the available version of each package.
+
+    Schema 1 indexes hold every manifest version, so the installed version is included
+    too. Schema 2 indexes hold each package's latest version.
+    """
+    connection = sqlite3.connect(path)
+    with connection:
+        if schema == 1:
+            connection.executescript("""
+                CREATE TABLE ids(rowid INTEGER PRIMARY KEY, id TEXT NOT NULL);
+                CREATE UNIQUE INDEX ids_pkindex ON ids(id);
+                CREATE TABLE names(rowid INTEGER PRIMARY KEY, name TEXT NOT NULL);
+                CREATE TABLE versions(rowid INTEGER PRIMARY KEY, version TEXT NOT NULL);
+                CREATE TABLE manifest(rowid INTEGER PRIMARY KEY, id INT64 NOT NULL, name INT64 NOT NULL, version INT64 NOT NULL);
+                CREATE INDEX manifest_id_index ON manifest(id);
+            """)
+            for rowid, (name, package_id, version, available, _) in enumerate(packages, start=1):
+                connection.execute("INSERT INTO ids VALUES (?, ?)", (rowid, package_id))
+                connection.execute("INSERT INTO names VALUES (?, ?)", (rowid, name))
+                for manifest_version in (version, available):
+                    version_rowid = connection.execute("INSERT INTO versions(version) VALUES (?)", (manifest_version,)).lastrowid
+                    connection.execute(
+                        "INSERT INTO manifest(id, name, version) VALUES (?, ?, ?)",
+                        (rowid, rowid, version_rowid),
+                    )
+        else:
+            connection.execute("""
+                CREATE TABLE packages(rowid INTEGER PRIMARY KEY, id TEXT NOT NULL, name TEXT NOT NULL, latest_version TEXT NOT NULL)
+            """)
+            connection.execute("CREATE UNIQUE INDEX packages_id_index ON packages(id)")
+            connection.executemany(
+                "INSERT INTO packages(id, name, latest_version) VALUES (?, ?, ?)",
+                [(package_id, name, available) for name, package_id, _, available, _ in packages],
+            )
+    connection.close()
+
+
+def make_export_file(packages):
+    """Return the contents of a "winget export --include-versions" file listing packages as installed."""
+    return {
+        "$schema": "https://aka.ms/winget-packages.schema.2.0.json",
+        "CreationDate": "2024-01-01T00:00:00.000-00:00",
+        "Sources": [
+            {
+                "Packages": [
+                    {"PackageIdentifier": package_id, "Version": version}
+                    for _, package_id, version, _, _
+                    in packages
+                ],
+                "SourceDetails": {
+                    "Argument": "https://cdn.winget.microsoft.com/cache",
+                    "Identifier": "Microsoft.Winget.Source_8wekyb3d8bbwe",
+                    "Name": "winget",
+                    "Type": "Microsoft.PreIndexed.Package",
+                },
+            }
+        ],
+        "WinGetVersion": "1.21.3482",
+    }
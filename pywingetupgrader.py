@@ -1,23 +1,201 @@
+import argparse
+import cProfile
+import hashlib
+import heapq
 import json
 import logging
+import math
+import operator
 import os
+import queue
 import re
+import shutil
+import socket
+import sqlite3
 import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import unicodedata
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+from urllib.request import pathname2url
 
-SEMVER_PATTERN = re.compile("^\d+?\.\d+?\.\d+$")
+WINDOWS_APPS_DIR = r"C:\Program Files\WindowsApps"
+
+# Seconds an upgrade may take when there's no history to base its timeout on
+DEFAULT_UPGRADE_TIMEOUT = 250
+
+# Recorded as the error of upgrade attempts that ran out of time
+TIMED_OUT_ERROR = "timed out"
+
+# The leading dotted number of a version, after any comparison operator or "v" prefix,
+# e.g. "1.2.3.4", "2023.1", "< 1.0", "v2.0-beta"
+VERSION_PATTERN = re.compile(r"^\s*(?:[<>]=?|=)?\s*[vV]?(\d+(?:\.\d+)*)")
+
+# Parsed versions are kept for the whole run, which lists at most two per application
+VERSION_CACHE_SIZE = None
+
+# Upgrade distance by the index of the first version part that differs
+UPGRADE_DISTANCES = ("major", "minor", "patch")
+
+# winget table headers in the order their values are stored on an Application
+APPLICATION_COLUMNS = ("Name", "Id", "Version", "Available", "Source")
+
+
+class Application(NamedTuple):
+    """An application listed by winget.
+
+    Versions are parsed when parsed_version or parsed_available is read rather than when
+    the listing is, so applications filtered out by id never parse theirs. parse_version()
+    memoizes each version string, so reading them again doesn't parse them again.
+    """
+    name: str
+    id: str
+    version: str
+    available: str
+    source: str = ""
+
+    @property
+    def parsed_version(self) -> Optional[Tuple[int, ...]]:
+        return parse_version(self.version)
+
+    @property
+    def parsed_available(self) -> Optional[Tuple[int, ...]]:
+        return parse_version(self.available)
+
+    def to_dict(self):
+        return {**self._asdict(), "parsed_version": self.parsed_version, "parsed_available": self.parsed_available}
+
+
+@lru_cache(maxsize=VERSION_CACHE_SIZE)
+def parse_version(version):
+    """Return version as a tuple of ints that compares correctly with other parsed versions.
+
+    Anything after the leading dotted number is ignored and trailing zeros are dropped,
+    so "1.2", "1.2.0" and "v1.2.0-beta" all parse to (1, 2). Returns None for versions
+    without a leading number such as "Unknown".
+    """
+    # Most versions are plain dotted numbers, which are quicker to split than to match
+    if version.isascii() and version.replace(".", "").isdigit():
+        try:
+            return drop_trailing_zeros(tuple(map(int, version.split("."))))
+        except ValueError:
+            # An empty part such as in "1..2"
+            pass
+    match = VERSION_PATTERN.match(version)
+    if match is None:
+        return None
+    return drop_trailing_zeros(tuple(map(int, match.group(1).split("."))))
+
+
+def drop_trailing_zeros(parts):
+    end = len(parts)
+    while end > 1 and parts[end - 1] == 0:
+        end -= 1
+    return parts[:end]
+
+
+def get_upgrade_distance(current, available):
+    """Return "major", "minor" or "patch" for the first part that differs between two
+    parsed versions, or None if available is not newer than current.
+
+    Every part after the minor version counts as a patch.
+    """
+    if not current < available:
+        return None
+    shortest = min(len(current), len(available))
+    index = 0
+    while index < shortest and current[index] == available[index]:
+        index += 1
+    if index == shortest:
+        # One version is a prefix of the other, the rest of the longer one is compared
+        # against implicit zeros. Trailing zeros were dropped when parsing so this stops.
+        longer = current if len(current) > len(available) else available
+        while longer[index] == 0:
+            index += 1
+    return UPGRADE_DISTANCES[min(index, len(UPGRADE_DISTANCES) - 1)]
 
 
 def get_bool_env_var(key, default):
     return os.environ.get(key, str(default)).lower() == "true"
 
-def get_applications_available_to_upgrade(winget_exe_path):
+def get_float_env_var(key, default):
+    try:
+        return float(os.environ.get(key, default))
+    except ValueError:
+        logging.warning(f"Ignoring invalid value for {key}, using default of {default}")
+        return default
+
+def get_int_env_var(key, default):
+    try:
+        return int(os.environ.get(key, default))
+    except ValueError:
+        logging.warning(f"Ignoring invalid value for {key}, using default of {default}")
+        return default
+
+def get_applications_available_to_upgrade(winget_exe_path, source=None, cache_ttl=0, cache_path=None, index_db_path=None, use_export=False, snapshot=None, inventory_cache_path=None):
+    """Yield applications with upgrades available as "winget upgrade" writes them.
+
+    Output is read line by line from a pipe so callers can start work before the
+    listing has finished. When cache_ttl is positive a listing cached at cache_path
+    less than cache_ttl seconds ago is used instead of running winget. When
+    index_db_path is given, available versions are read from that winget source index
+    instead of running "winget upgrade", with installed packages cached at
+    inventory_cache_path, see iter_index_upgrade_listing(). Otherwise when
+    use_export is set, values winget truncated in its table are completed from
+    "winget export", see iter_with_exported_packages(). When a ListingSnapshot is given,
+    the table is read in full and only parsed if it differs from the snapshot's, and once
+    the listing has completed the snapshot's output_sha256 is updated and it is marked
+    as listed.
+    """
+    output_sha256 = None
     try:
-        # Hack to ensure source agreements are accepted so that "winget upgrade" command returns
-        # results in an expected format
-        subprocess.check_output([winget_exe_path, "list", "--accept-source-agreements", "-n", "1"], timeout=15)
-        output = subprocess.check_output([winget_exe_path, "upgrade"])
-        output = output.decode('utf-8')
-        return output
+        if cache_ttl > 0:
+            cache_key = get_listing_cache_key(winget_exe_path, source, "index" if index_db_path else "table", use_export)
+            cached_applications = read_cached_applications(cache_path, cache_key, cache_ttl)
+            if cached_applications is not None:
+                logging.debug(f"[-] Using {len(cached_applications)} applications cached at '{cache_path}'")
+                yield from cached_applications
+                if snapshot is not None:
+                    snapshot.listed = True
+                return
+
+        if index_db_path:
+            listing = iter_index_upgrade_listing(winget_exe_path, index_db_path, source, inventory_cache_path)
+        elif snapshot is not None:
+            rows = read_winget_upgrade_rows(winget_exe_path, source)
+            output_sha256 = hash_rows(rows)
+            if output_sha256 == snapshot.output_sha256:
+                logging.debug("[-] winget's output hasn't changed since the last run, reusing its applications")
+                listing = snapshot.applications
+            else:
+                listing = iter_applications_from_rows(rows)
+                if use_export:
+                    listing = iter_with_exported_packages(listing, winget_exe_path)
+        else:
+            listing = iter_winget_upgrade_listing(winget_exe_path, source)
+            if use_export:
+                listing = iter_with_exported_packages(listing, winget_exe_path)
+
+        applications = []
+        for app in listing:
+            if cache_ttl > 0:
+                applications.append(app)
+            yield app
+
+        if cache_ttl > 0:
+            write_cached_applications(cache_path, cache_key, applications)
+        if snapshot is not None:
+            # Only a complete listing may be compared with the next run's
+            if output_sha256 is not None:
+                snapshot.output_sha256 = output_sha256
+            snapshot.listed = True
     except FileNotFoundError as exc:
         logging.error(f"Process failed because the winget executable could not be found.")
     except subprocess.CalledProcessError as exc:
@@ -25,35 +203,604 @@ def get_applications_available_to_upgrade(winget_exe_path):
                 f"Process failed because it did not return a successful return code. "
                 f"Returned {exc.returncode}\n{exc}"
             )
-    except subprocess.TimeoutExpired as exc:
-        logging.error(f"Process timed out whilst identify apps to upgrade'.\n{exc}")
+    except sqlite3.Error as exc:
+        logging.error(f"Unable to read available versions from the winget source index '{index_db_path}'.\n{exc}")
+
 
+def iter_winget_upgrade_listing(winget_exe_path, source=None):
+    source_args = ["--source", source] if source else []
+    # Accepting source agreements up front stops winget prompting for them, which would
+    # otherwise leave the output in an unexpected format
+    with subprocess.Popen(
+            [winget_exe_path, "upgrade", "--accept-source-agreements", *source_args],
+            stdout=subprocess.PIPE,
+        ) as process:
+        rows = (
+            line.decode('utf-8').rstrip("\r\n")
+            for line
+            in process.stdout
+        )
+        yield from iter_applications_from_rows(rows)
+        # Drain anything after the table so winget isn't blocked writing to a full pipe
+        process.stdout.read()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
 
 
-def extract_applications_from_table(output):
-    rows = output.split("\r\n")[:-2]
-    headers_and_their_starting_positions = get_headers_and_their_starting_positions(rows)
-    
-    records = []
-
-    # Start at the third row since the first row is headers and the second a line break
-    for row in rows[2:]:
-        record = {}
-        for i, (key, start_pos) in enumerate(headers_and_their_starting_positions):
-            # We don't have end_positions so we reuse the start position of the next header
-            if i < len(headers_and_their_starting_positions) - 1:
-                _, end_pos = headers_and_their_starting_positions[i+1]
-                record[key] = row[start_pos:end_pos].strip()
-            # ...except for the final header
+def read_winget_upgrade_rows(winget_exe_path, source=None):
+    """Return the rows "winget upgrade" writes, without the progress spinner drawn before its table."""
+    source_args = ["--source", source] if source else []
+    completed_process = subprocess.run(
+        [winget_exe_path, "upgrade", "--accept-source-agreements", *source_args],
+        capture_output=True,
+        check=True,
+    )
+    return [
+        line.rstrip("\r").rsplit("\r", 1)[-1]
+        for line
+        in decode_output(completed_process.stdout).split("\n")
+    ]
+
+
+def hash_rows(rows):
+    sha256 = hashlib.sha256()
+    for row in rows:
+        sha256.update(row.encode("utf-8") + b"\n")
+    return sha256.hexdigest()
+
+
+# The only source whose index is a local database
+INDEX_SOURCE = "winget"
+
+# Keeps queries well under SQLite's limit on the number of parameters
+INDEX_QUERY_CHUNK_SIZE = 500
+
+
+def iter_index_upgrade_listing(winget_exe_path, index_db_path, source=None, inventory_cache_path=None):
+    """Yield applications with upgrades available by comparing installed packages with the
+    latest versions in the winget source's local index database.
+
+    Installed packages come from winget, through "winget export", unless nothing has been
+    installed, upgraded or removed since they were cached at inventory_cache_path, see
+    get_cached_installed_packages(). No upgrade applicability checks are run. Only
+    packages from the winget source are listed.
+    """
+    if source and source != INDEX_SOURCE:
+        logging.warning(f"The '{source}' source can't be read from an index database, no upgrades will be listed")
+        return
+
+    installed_versions = {
+        package_id: version
+        for package_source, package_id, version
+        in get_cached_installed_packages(winget_exe_path, inventory_cache_path)
+        if package_source == INDEX_SOURCE
+    }
+
+    for package_id, name, latest_version in query_latest_versions(index_db_path, installed_versions):
+        app = Application(name, package_id, installed_versions[package_id], latest_version, INDEX_SOURCE)
+        if (
+            app.parsed_version is not None
+            and app.parsed_available is not None
+            and app.parsed_version < app.parsed_available
+        ):
+            yield app
+
+
+# Registry keys listing installed programs, which winget export reads besides MSIX packages
+INSTALLED_PROGRAMS_KEYS = (
+    ("HKEY_LOCAL_MACHINE", r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall"),
+    ("HKEY_LOCAL_MACHINE", r"SOFTWARE\WOW6432Node\Microsoft\Windows\CurrentVersion\Uninstall"),
+    ("HKEY_CURRENT_USER", r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall"),
+)
+
+# Written whenever an MSIX package is installed, upgraded or removed
+APP_REPOSITORY_PATH = r"C:\ProgramData\Microsoft\Windows\AppRepository\StateRepository-Machine.srd"
+
+
+def get_cached_installed_packages(winget_exe_path, cache_path=None):
+    """Return get_installed_packages(), reusing the packages cached at cache_path if the
+    installed programs haven't changed since, see get_installed_programs_stamp()."""
+    stamp = get_installed_programs_stamp() if cache_path else None
+    if stamp is not None:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get("stamp") == stamp:
+                logging.debug(f"[-] Installed programs haven't changed, using the packages cached at '{cache_path}'")
+                return [tuple(package) for package in cache["packages"]]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    installed_packages = get_installed_packages(winget_exe_path)
+    if stamp is not None:
+        try:
+            write_json_atomically(cache_path, {"stamp": stamp, "packages": installed_packages})
+        except OSError as exc:
+            logging.warning(f"Unable to write installed packages cache '{cache_path}'. {exc}")
+    return installed_packages
+
+
+def get_installed_programs_stamp():
+    """Return a value that changes whenever a program is installed, upgraded or removed,
+    read without launching winget, or None if it can't be read, e.g. off Windows.
+
+    It's made from the last write time of every installed program's uninstall registry
+    key, and of the MSIX state repository.
+    """
+    try:
+        import winreg
+    except ImportError:
+        return None
+
+    write_times = []
+    for hive_name, key_path in INSTALLED_PROGRAMS_KEYS:
+        try:
+            with winreg.OpenKey(getattr(winreg, hive_name), key_path) as key:
+                subkey_count, _, write_time = winreg.QueryInfoKey(key)
+                write_times.append(write_time)
+                for index in range(subkey_count):
+                    with winreg.OpenKey(key, winreg.EnumKey(key, index)) as subkey:
+                        write_times.append(winreg.QueryInfoKey(subkey)[2])
+        except OSError:
+            write_times.append(None)
+    try:
+        write_times.append(os.path.getmtime(APP_REPOSITORY_PATH))
+    except OSError:
+        write_times.append(None)
+    return hashlib.sha256(json.dumps(write_times).encode("utf-8")).hexdigest()
+
+
+def get_installed_packages(winget_exe_path):
+    """Return (source, id, version) for each installed package that winget can export."""
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        export_file_path = os.path.join(temporary_dir, "installed.json")
+        subprocess.run([
+                winget_exe_path,
+                "export",
+                "--output",
+                export_file_path,
+                "--include-versions",
+                "--accept-source-agreements",
+            ], check=True, capture_output=True
+        )
+        with open(export_file_path, encoding="utf-8") as f:
+            return list(iter_exported_packages(f))
+
+
+EXPORT_SOURCES_PATTERN = re.compile(r'"Sources"\s*:\s*\[')
+
+
+def iter_exported_packages(f, chunk_size=65536):
+    """Yield (source, id, version) from a "winget export" file as it is read.
+
+    Only one source's entry is decoded and held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = None
+
+    def read_more():
+        nonlocal buffer
+        chunk = f.read(chunk_size)
+        buffer += chunk
+        return bool(chunk)
+
+    while position is None:
+        match = EXPORT_SOURCES_PATTERN.search(buffer)
+        if match is not None:
+            position = match.end()
+        elif not read_more():
+            return
+
+    while True:
+        # Skip to the start of the next source, or the end of the list
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            if not read_more():
+                raise ValueError("Unexpected end of winget export file")
+            continue
+        if buffer[position] == "]":
+            return
+
+        try:
+            source, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The source's entry hasn't been read in full yet
+            if not read_more():
+                raise
+            continue
+
+        source_name = source.get("SourceDetails", {}).get("Name", "")
+        for package in source.get("Packages", []):
+            yield source_name, package["PackageIdentifier"], package.get("Version", "Unknown")
+
+        buffer = buffer[end:]
+        position = 0
+
+
+# winget ends values that are too wide for their column with an ellipsis
+TRUNCATION_MARKER = "\u2026"
+
+
+def iter_with_exported_packages(applications, winget_exe_path):
+    """Yield applications with ids and versions truncated in winget's table replaced by the
+    full values from "winget export".
+
+    The export runs alongside the listing and is only waited for once a truncated value
+    needs resolving.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        installed_packages_future = executor.submit(get_installed_packages, winget_exe_path)
+        installed_versions = None
+        for app in applications:
+            if app.id.endswith(TRUNCATION_MARKER) or app.version.endswith(TRUNCATION_MARKER):
+                if installed_versions is None:
+                    installed_versions = get_exported_versions(installed_packages_future)
+                    sorted_installed_ids = sorted(installed_versions)
+                app = resolve_truncated_application(app, installed_versions, sorted_installed_ids)
+            yield app
+
+
+def get_exported_versions(installed_packages_future):
+    try:
+        return {
+            package_id: version
+            for _, package_id, version
+            in installed_packages_future.result()
+        }
+    except (OSError, ValueError, subprocess.CalledProcessError) as exc:
+        logging.warning(f"Unable to export installed packages, truncated ids can't be resolved. {exc}")
+        return {}
+
+
+def resolve_truncated_application(app, installed_versions, sorted_installed_ids):
+    package_id = app.id
+    if package_id.endswith(TRUNCATION_MARKER):
+        matching_ids = find_ids_with_prefix(sorted_installed_ids, package_id[:-1])
+        if len(matching_ids) != 1:
+            logging.warning(f"Unable to resolve truncated id '{package_id}', {len(matching_ids)} installed packages match")
+            return app
+        package_id = matching_ids[0]
+
+    version = app.version
+    if version.endswith(TRUNCATION_MARKER) and package_id in installed_versions:
+        version = installed_versions[package_id]
+
+    return app._replace(id=package_id, version=version)
+
+
+def find_ids_with_prefix(sorted_ids, prefix):
+    matching_ids = []
+    for package_id in sorted_ids[bisect_left(sorted_ids, prefix):]:
+        if not package_id.startswith(prefix):
+            break
+        matching_ids.append(package_id)
+    return matching_ids
+
+
+def query_latest_versions(index_db_path, package_ids):
+    """Yield (id, name, latest version) from a winget source index for each of package_ids it contains."""
+    package_ids = list(package_ids)
+    # Opened read only so winget's copy is never modified or locked for writing
+    connection = sqlite3.connect(f"file:{pathname2url(os.path.abspath(index_db_path))}?mode=ro", uri=True)
+    try:
+        tables = {
+            name
+            for name,
+            in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+        for i in range(0, len(package_ids), INDEX_QUERY_CHUNK_SIZE):
+            chunk = package_ids[i:i + INDEX_QUERY_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            if "packages" in tables:
+                # Newer indexes store the latest version of each package directly
+                yield from connection.execute(
+                    f"SELECT id, name, latest_version FROM packages WHERE id IN ({placeholders})",
+                    chunk,
+                )
             else:
-                record[key] = row[start_pos:].strip()
-        records.append(record)
+                yield from get_latest_manifest_versions(connection.execute(
+                    f"""
+                    SELECT ids.id, names.name, versions.version
+                    FROM manifest
+                    JOIN ids ON ids.rowid = manifest.id
+                    JOIN names ON names.rowid = manifest.name
+                    JOIN versions ON versions.rowid = manifest.version
+                    WHERE ids.id IN ({placeholders})
+                    """,
+                    chunk,
+                ))
+    finally:
+        connection.close()
+
+
+def get_latest_manifest_versions(manifest_rows):
+    """Reduce (id, name, version) rows for every manifest to the row with each id's highest version."""
+    latest = {}
+    for package_id, name, version in manifest_rows:
+        parsed_version = parse_version(version)
+        if parsed_version is None:
+            continue
+        if package_id not in latest or latest[package_id][0] < parsed_version:
+            latest[package_id] = (parsed_version, name, version)
+    return [
+        (package_id, name, version)
+        for package_id, (_, name, version)
+        in latest.items()
+    ]
+
+
+def find_source_index_path(winapps_dir_path=WINDOWS_APPS_DIR):
+    """Return the index database of the highest installed version of the winget source."""
+    dir_paths = [
+        dir_
+        for dir_
+        in os.listdir(winapps_dir_path)
+        if dir_.startswith("Microsoft.Winget.Source_")
+    ]
+    if not dir_paths:
+        raise FileNotFoundError("Unable to locate the winget source index")
+
+    dir_path = max(dir_paths, key=get_windows_app_version)
+    return os.path.join(winapps_dir_path, dir_path, "Public", "index.db")
+
+
+def get_state_dir():
+    """Return the directory used to persist state between runs, creating it if needed."""
+    state_dir = os.environ.get("WINGET_STATE_DIR") or os.path.join(
+        os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"),
+        "pywingetupgrader",
+    )
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def write_json_atomically(path, data):
+    # Write to a temporary file first so readers never see a partially written file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temporary_path, path)
+
+
+def get_winget_version(winget_exe_path):
+    # winget lives in a directory named like
+    # Microsoft.DesktopAppInstaller_1.21.3482.0_x64__8wekyb3d8bbwe
+    package_dir_name = os.path.basename(os.path.dirname(winget_exe_path))
+    if package_dir_name.startswith("Microsoft.DesktopAppInstaller_"):
+        return package_dir_name.split("_")[1]
+    # Otherwise fall back to identifying the executable by its modification time
+    return f"{winget_exe_path}@{os.stat(winget_exe_path).st_mtime}"
+
+
+def get_listing_cache_key(winget_exe_path, source, listing_backend, use_export):
+    return {
+        "winget_version": get_winget_version(winget_exe_path),
+        "source": source or "",
+        "listing_backend": listing_backend,
+        "use_export": use_export,
+    }
+
+
+def read_cached_applications(cache_path, cache_key, cache_ttl):
+    """Return the cached applications, or None if the cache is missing, stale or for another key."""
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        logging.debug(f"[-] Ignoring unreadable listing cache '{cache_path}'. {exc}")
+        return None
+
+    age = time.time() - cache.get("created", 0)
+    if cache.get("key") != cache_key or not 0 <= age < cache_ttl:
+        return None
+
+    return [
+        Application(*columns)
+        for columns
+        in cache["applications"]
+    ]
+
+
+def write_cached_applications(cache_path, cache_key, applications):
+    try:
+        write_json_atomically(cache_path, {
+            "key": cache_key,
+            "created": time.time(),
+            "applications": [app[:len(APPLICATION_COLUMNS)] for app in applications],
+        })
+    except OSError as exc:
+        logging.warning(f"Unable to write listing cache '{cache_path}'. {exc}")
+
+
+def invalidate_listing_cache(cache_path):
+    try:
+        os.remove(cache_path)
+    except FileNotFoundError:
+        pass
+
+
+SNAPSHOT_VERSION = 1
+
+
+class ListingSnapshot:
+    """What the last run listed and decided, so a run only evaluates what has changed since.
+
+    output_sha256 is the hash of the last "winget upgrade" table and applications the
+    applications listed in it. settled maps the package ids of applications that were
+    evaluated but not selected for upgrade to their installed and available versions;
+    they aren't evaluated again until either version changes. key describes the
+    configuration the decisions were made with, see get_snapshot_key().
+    """
+
+    def __init__(self, key, output_sha256=None, applications=(), settled=None):
+        self.key = key
+        self.output_sha256 = output_sha256
+        self.applications = list(applications)
+        self.settled = settled or {}
+        # Whether this run's listing completed, see get_applications_available_to_upgrade()
+        self.listed = False
 
-    return records
+    @classmethod
+    def read(cls, path, key):
+        """Return the snapshot at path, or an empty one if it is missing or has another key."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return cls(key)
+        except (OSError, ValueError) as exc:
+            logging.debug(f"[-] Ignoring unreadable listing snapshot '{path}'. {exc}")
+            return cls(key)
+
+        if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("key") != key:
+            logging.debug("[-] Ignoring listing snapshot taken with another configuration")
+            return cls(key)
+        return cls(
+            key,
+            snapshot["output_sha256"],
+            [Application(*columns) for columns in snapshot["applications"]],
+            snapshot["settled"],
+        )
+
+    def write(self, path):
+        try:
+            write_json_atomically(path, {
+                "version": SNAPSHOT_VERSION,
+                "key": self.key,
+                "output_sha256": self.output_sha256,
+                "applications": [app[:len(APPLICATION_COLUMNS)] for app in self.applications],
+                "settled": self.settled,
+            })
+        except OSError as exc:
+            logging.warning(f"Unable to write listing snapshot '{path}'. {exc}")
+
+    def is_settled(self, app):
+        return self.settled.get(app.id) == [app.version, app.available]
+
+    def get_changed(self, applications):
+        """Return the applications that are new or have changed versions since the last run."""
+        return [app for app in applications if not self.is_settled(app)]
+
+    def update(self, applications, evaluated, selected):
+        """Record this run's applications, and which of the evaluated ones weren't selected."""
+        evaluated_ids = {app.id for app in evaluated}
+        selected_ids = {app.id for app in selected}
+        self.settled = {
+            app.id: [app.version, app.available]
+            for app
+            in applications
+            if (app.id in evaluated_ids or self.is_settled(app)) and app.id not in selected_ids
+        }
+        self.applications = list(applications)
+
+
+def get_snapshot_key(winget_exe_path, source, upgrade_level, upgrade_unknowns, listing_backend, use_export):
+    return {
+        "winget_version": get_winget_version(winget_exe_path),
+        "source": source or "",
+        "upgrade_level": upgrade_level,
+        "upgrade_unknowns": upgrade_unknowns,
+        "listing_backend": listing_backend,
+        "use_export": use_export,
+        "allowed": sorted(get_allowed_updates()),
+        "blocked": sorted(get_blocked_updates()),
+    }
+
+
+def extract_applications_from_table(output):
+    return list(iter_applications_from_rows(output.split("\r\n")))
+
+
+def iter_applications_from_rows(rows):
+    """Yield an application record for each row of a winget table.
+
+    Column positions are fixed as soon as the header and separator rows have been seen.
+    The table ends at the first row too short to reach the final column, which skips the
+    "N upgrades available." summary and anything written after it.
+    """
+    rows = iter(rows)
+    header_row = None
+    for row in rows:
+        if header_row is not None and is_separator_row(row):
+            break
+        header_row = row
+    else:
+        return
+
+    column_slicer = ColumnSlicer(get_headers_and_their_starting_positions([header_row]))
+    yield from column_slicer.iter_records(rows)
+
+
+def is_separator_row(row):
+    stripped_row = row.strip()
+    return bool(stripped_row) and set(stripped_row) == {"-"}
+
+
+class ColumnSlicer:
+    """Turns table rows into Applications using column offsets computed once from the header."""
+
+    __slots__ = ("final_start_pos", "_extract")
+
+    def __init__(self, headers_and_their_starting_positions):
+        starting_positions = [start_pos for _, start_pos in headers_and_their_starting_positions]
+        self.final_start_pos = starting_positions[-1]
+        # We don't have end positions so we reuse the start position of the next header,
+        # except for the final header which runs to the end of the row
+        slices_by_header = {
+            key: slice(start_pos, end_pos)
+            for (key, start_pos), end_pos
+            in zip(headers_and_their_starting_positions, starting_positions[1:] + [None])
+        }
+        # Columns missing from the table are read as empty strings
+        self._extract = operator.itemgetter(*(
+            slices_by_header.get(column, slice(0, 0))
+            for column
+            in APPLICATION_COLUMNS
+        ))
+
+    def iter_records(self, rows):
+        """Yield an Application per row, stopping at the first row too short to reach the final column."""
+        extract, final_start_pos, make = self._extract, self.final_start_pos, Application._make
+        for row in rows:
+            if not row.isascii():
+                row = pad_wide_characters(row)
+                if len(row) <= final_start_pos:
+                    return
+                yield self._from_wide_row(row)
+                continue
+            if len(row) <= final_start_pos:
+                return
+            yield make(map(str.strip, extract(row)))
+
+    def _from_wide_row(self, padded_row):
+        return Application._make(
+            cell.replace(WIDE_CHARACTER_PADDING, "").strip()
+            for cell
+            in self._extract(padded_row)
+        )
+
+
+# Inserted after each double width character so that offsets into a row match the console
+# columns winget aligned the table to
+WIDE_CHARACTER_PADDING = "\0"
+
+
+def pad_wide_characters(row):
+    return "".join(
+        character + WIDE_CHARACTER_PADDING if unicodedata.east_asian_width(character) in ("W", "F") else character
+        for character
+        in row
+    )
 
 
 def get_headers_and_their_starting_positions(rows):
-    header_row = rows[0]
+    # winget draws a progress spinner using carriage returns before printing the header,
+    # only the text after the final one is visible on the console
+    header_row = rows[0].rsplit("\r", 1)[-1]
     headers = [
         v
         for v
@@ -70,204 +817,2118 @@ def get_headers_and_their_starting_positions(rows):
     return headers_and_their_starting_positions
 
 
-def get_applications_using_semver(applications):
+def get_applications_with_comparable_versions(applications):
     return [
-        add_semver_details(app)
+        app
         for app
         in applications
-        if SEMVER_PATTERN.match(app["Version"]) or SEMVER_PATTERN.match(app["Available"])
+        if app.parsed_version is not None or app.parsed_available is not None
     ]
 
 
-def add_semver_details(app):
-    if SEMVER_PATTERN.match(app["Version"]):
-        major, minor, patch  = app["Version"].split(".")
-        app["current_major"] = int(major)
-        app["current_minor"] = int(minor)
-        app["current_patch"] = int(patch)
-    if SEMVER_PATTERN.match(app["Available"]):
-        available_major, available_minor, available_patch  = app["Available"].split(".")
-        app["available_major"] = int(available_major)
-        app["available_minor"] = int(available_minor)
-        app["available_patch"] = int(available_patch)
-    
-    return app
+def upgrade_app(app, winget_exe_path, timeout=DEFAULT_UPGRADE_TIMEOUT):
+    __id = app.id
+    logging.info(f'Attempting to upgrade {app.id} from version {app.version} to {app.available}')
 
+    # Pinned so the version upgraded to is the one selected, like a batch or a plan, unless
+    # winget truncated it or it isn't a version winget could be asked for
+    if app.available.endswith(TRUNCATION_MARKER) or app.parsed_available is None:
+        version_args = []
+    else:
+        version_args = ["--version", app.available]
 
-def upgrade_app(app, winget_exe_path):
-    __id = app["Id"]
-    logging.info(f'Attempting to upgrade {app["Id"]} from version {app["Version"]} to {app["Available"]}')
-    
+    return run_upgrade_process(app, [
+            winget_exe_path,
+            "upgrade", 
+            "--silent",
+            "--id", 
+            __id,
+            *version_args,
+            "--accept-package-agreements",
+            "--accept-source-agreements",
+            # Commenting out logging as it is quite noisy by default
+            # "--log",
+            # "./winget-upgrades.log",
+
+            # Commenting out --override as it seems to mess with --silent. Maybe.
+            # "--override",
+            # '"/norestart"',
+        ], timeout
+    )
+
+
+def run_upgrade_process(app, args, timeout, program="winget", success_codes=(0,)):
+    """Run the process upgrading app and return its result, see make_upgrade_result()."""
+    __id = app.id
+    result = make_upgrade_result(app)
+    result["timeout"] = timeout
+    start = time.perf_counter()
     try:
-        subprocess.run([
-                winget_exe_path,
-                "upgrade", 
-                "--silent",
-                "--id", 
-                __id,
-                "--accept-package-agreements",
-                "--accept-source-agreements",
-                # Commenting out logging as it is quite noisy by default
-                # "--log",
-                # "./winget-upgrades.log",
-
-                # Commenting out --override as it seems to mess with --silent. Maybe.
-                # "--override",
-                # '"/norestart"',
-            ], timeout=250
-        )
+        completed_process = subprocess.run(args, timeout=timeout, capture_output=True)
+        result["returncode"] = completed_process.returncode
+        result["stdout"] = decode_output(completed_process.stdout)
+        result["stderr"] = decode_output(completed_process.stderr)
+        if completed_process.returncode not in success_codes:
+            result["error"] = f"{program} returned {completed_process.returncode}"
+            logging.error(
+                f"Process failed to upgrade '{__id}' because did not return a successful return code. "
+                f"Returned {completed_process.returncode}"
+            )
     except FileNotFoundError as exc:
+        result["error"] = "executable not found"
         logging.error(f"Process failed to upgrade '{__id}' because the executable could not be found.")
     except subprocess.CalledProcessError as exc:
+        result["returncode"] = exc.returncode
+        result["error"] = f"{program} returned {exc.returncode}"
         logging.error(
                 f"Process failed to upgrade '{__id}' because did not return a successful return code. "
                 f"Returned {exc.returncode}\n{exc}"
             )
     except subprocess.TimeoutExpired as exc:
+        result["stdout"] = decode_output(exc.stdout)
+        result["stderr"] = decode_output(exc.stderr)
+        result["error"] = TIMED_OUT_ERROR
         logging.error(f"Process timed out whilst trying to upgrade '{__id}'.\n{exc}")
+    finally:
+        result["duration"] = time.perf_counter() - start
 
-def get_apps_to_upgrade(applications, upgrade_level, upgrade_unknowns):
-    
-    applications_using_semver = get_applications_using_semver(applications)
+    return result
 
-    apps_to_upgrade = []
-    
-    if upgrade_level.lower() == "all":
-        return applications
 
+def make_upgrade_result(app):
+    return {
+        "id": app.id,
+        "version": app.version,
+        "available": app.available,
+        "started_at": time.time(),
+        "returncode": None,
+        "duration": 0.0,
+        "stdout": "",
+        "stderr": "",
+        "error": None,
+        "batched": False,
+        "prefetched": False,
+        "download_duration": 0.0,
+        "timeout": None,
+    }
 
-    apps_with_patch_upgrades = [
-        app
-        for app
-        in applications_using_semver
-        if "current_major" in app and "available_major" in app and app["current_major"] == app["available_major"] and app["current_minor"] == app["available_minor"] and app["current_patch"] < app["available_patch"]
-    ]
 
-    apps_with_minor_upgrades = [
-        app
-        for app
-        in applications_using_semver
-        if "current_major" in app and "available_major" in app and app["current_major"] == app["available_major"] and app["current_minor"] < app["available_minor"]
-    ]
+def decode_output(output):
+    if output is None:
+        return ""
+    return output.decode("utf-8", errors="replace")
 
-    apps_with_major_upgrades = [
-        app
-        for app
-        in applications_using_semver
-        if "current_major" in app and "available_major" in app and app["current_major"] < app["available_major"]
-    ]
 
-    apps_with_unknown_current_version = [
-        app
-        for app
-        in applications_using_semver
-        if app["Version"].lower() == "unknown"
-    ]
+# Installer types that use Windows Installer, which only runs one installation at a time.
+# Burn bundles are chains of MSIs.
+WINDOWS_INSTALLER_TYPES = ("msi", "wix", "burn")
+INSTALLER_TYPE_PATTERN = re.compile(r"^\s*Installer Type:\s*(\S+)", re.MULTILINE)
+INSTALLER_SHA256_PATTERN = re.compile(r"^\s*Installer SHA256:\s*([0-9A-Fa-f]{64})\s*$", re.MULTILINE)
 
-    if upgrade_level == "patch":
-        apps_to_upgrade = apps_with_patch_upgrades
 
-    elif upgrade_level == "minor":
-        apps_to_upgrade = apps_with_minor_upgrades + apps_with_patch_upgrades
+def get_installer_types(apps, winget_exe_path, cache_path, max_workers=1):
+    """Return the type of the installer each app will be upgraded with, keyed by package id.
 
-    elif upgrade_level == "major":
-        apps_to_upgrade = apps_with_major_upgrades + apps_with_minor_upgrades + apps_with_patch_upgrades
-    
-    if upgrade_unknowns:
-        apps_to_upgrade += apps_with_unknown_current_version
-    
-    return apps_to_upgrade
+    Types are read from "winget show" and cached by package id and available version.
+    Apps whose type can't be found are left out.
+    """
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached_types = json.load(f)
+    except (OSError, ValueError):
+        cached_types = {}
 
+    keys = {app.id: f"{app.id}@{app.available}" for app in apps}
+    unresolved = [app for app in apps if keys[app.id] not in cached_types]
+    if unresolved:
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            resolved_types = list(executor.map(lambda app: get_installer_type(app, winget_exe_path), unresolved))
+        # Only the apps being upgraded are kept, so the cache doesn't grow with every version
+        cached_types = {key: cached_types[key] for key in keys.values() if key in cached_types}
+        cached_types.update(
+            (keys[app.id], installer_type)
+            for app, installer_type
+            in zip(unresolved, resolved_types)
+            if installer_type is not None
+        )
+        try:
+            write_json_atomically(cache_path, cached_types)
+        except OSError as exc:
+            logging.warning(f"Unable to cache installer types to '{cache_path}'. {exc}")
 
-def get_allowed_updates():
-    return set([
-        'Python.Python.3'
-        ])
+    return {app.id: cached_types[keys[app.id]] for app in apps if keys[app.id] in cached_types}
 
-def add_allowed_updates(apps_to_upgrade, applications):
-    allowed_applications = get_allowed_updates()
-    allowed_applications_with_upgrades_available = [
-        app
-        for app
-        in applications
-        if app["Id"] in allowed_applications
-    ]
-    return apps_to_upgrade + allowed_applications_with_upgrades_available
 
-def get_blocked_updates():
-    return set([
-        'EvanCzaplicki.Elm',
-        'VMware.WorkstationPro',
-        'CoreyButler.NVMforWindows',
-    ])
+def get_installer_type(app, winget_exe_path):
+    return parse_installer_type(show_installer(app, winget_exe_path))
 
-def remove_blocked_updates(apps_to_upgrade):
-    blocked_applications = get_blocked_updates()
-    return [
-        app
-        for app
-        in apps_to_upgrade
-        if app["Id"] not in blocked_applications
-    ]
 
-def get_winget_exe_path():
-    try:
-        winapps_dir_path = "C:\Program Files\WindowsApps"
-        dir_path = [
-            dir_ 
-            for dir_ 
-            in os.listdir(winapps_dir_path) 
-            if dir_.startswith('Microsoft.DesktopAppInstaller') and dir_.endswith('x64__8wekyb3d8bbwe')
-        ][0]
-
-        return os.path.join(winapps_dir_path, dir_path, "winget.exe")
-        
-    except PermissionError as e:
-        raise e
-    except IndexError:
-        raise FileNotFoundError("Unable to locate winget executable")
+def parse_installer_type(show_output):
+    match = INSTALLER_TYPE_PATTERN.search(show_output) if show_output is not None else None
+    return match.group(1).lower() if match else None
 
 
+def parse_installer_sha256(show_output):
+    match = INSTALLER_SHA256_PATTERN.search(show_output) if show_output is not None else None
+    return match.group(1).lower() if match else None
 
-def main():
+
+def show_installer(app, winget_exe_path):
+    """Return what "winget show" says about the installer of app's available version, or
+    None if it failed."""
     try:
-        WINGET_DEBUG = get_bool_env_var("WINGET_DEBUG", default=False)
-        upgrade_level = os.environ.get("WINGET_UPGRADE_LEVEL", "patch").lower()
-        upgrade_unknowns = get_bool_env_var("WINGET_UPGRADE_UNKNOWN_VERSIONS", False)
+        completed_process = subprocess.run([
+                winget_exe_path,
+                "show",
+                "--id",
+                app.id,
+                "--version",
+                app.available,
+                "--exact",
+                "--accept-source-agreements",
+            ], timeout=DEFAULT_UPGRADE_TIMEOUT, capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
+        logging.warning(f"Unable to show the installer of '{app.id}'. {exc}")
+        return None
+    return decode_output(completed_process.stdout)
 
-        
-        log_level = logging.DEBUG if WINGET_DEBUG else logging.INFO
-        logging.basicConfig(level=log_level)
-        
-        logging.debug("[-] Finding winget executable location...")
-        winget_exe_path = get_winget_exe_path()
 
-        logging.debug("[-] Calling 'winget update' to find applications to upgrade...")
-        upgradable_applications_table = get_applications_available_to_upgrade(winget_exe_path)
-        
-        logging.debug("[-] Parsing results...")
-        applications = extract_applications_from_table(upgradable_applications_table)
-        
-        logging.debug("[-] Filtering to include only applications that use semantic versioning...")
-        applications_using_semver = get_applications_using_semver(applications)
-        
-        logging.debug(f"[-] Filtering to include applications to upgrade based on selected upgrade level: '{upgrade_level}' and whether or not unknown applications should be updated: '{upgrade_unknowns}'")
-        apps_to_upgrade = get_apps_to_upgrade(applications_using_semver, upgrade_level, upgrade_unknowns)
-        
-        logging.debug("[-] Adding apps that are always allowed to upgrade")
-        apps_to_upgrade = add_allowed_updates(apps_to_upgrade, applications)
-        
-        logging.debug("[-] Removing apps that are always blocked from upgrading")
-        apps_to_upgrade = remove_blocked_updates(apps_to_upgrade)
-        
-        if WINGET_DEBUG:
-            logging.debug("[-] Listing apps that would have been upgraded:")
-            for app in apps_to_upgrade:
-                logging.debug(json.dumps(app, indent=2))
+def get_installer_lane(installer_type):
+    """Return the lane an installer of installer_type is run in, see LaneExecutor."""
+    # An unknown installer may use Windows Installer
+    if installer_type is None or installer_type in WINDOWS_INSTALLER_TYPES:
+        return "windows_installer"
+    return installer_type
 
-        else:
-            for app in apps_to_upgrade:
-                upgrade_app(app, winget_exe_path)
+
+class LaneExecutor:
+    """Runs work in lanes, one installation at a time in the "windows_installer" lane.
+
+    All lanes share a pool of max_workers workers. Work in the Windows Installer lane is
+    queued and run one item after another by a single worker, which returns to the pool
+    as soon as the queue is empty, so Windows Installer packages queue behind each other
+    without holding back any other type of installer.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max(max_workers, 1))
+        self._lock = threading.Lock()
+        self._windows_installer_queue = deque()
+        self._windows_installer_running = False
+
+    def submit(self, lane, fn, *args):
+        if lane != "windows_installer":
+            return self._executor.submit(fn, *args)
+        future = Future()
+        with self._lock:
+            self._windows_installer_queue.append((future, fn, args))
+            if self._windows_installer_running:
+                return future
+            self._windows_installer_running = True
+        self._executor.submit(self._run_windows_installer_queue)
+        return future
+
+    def _run_windows_installer_queue(self):
+        while True:
+            with self._lock:
+                if not self._windows_installer_queue:
+                    self._windows_installer_running = False
+                    return
+                future, fn, args = self._windows_installer_queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown(wait=True)
+
+
+def get_upgrade_lanes(apps, installer_types=None):
+    """Return the lane each app is upgraded in keyed by package id, or None for every app
+    if installer_types isn't given."""
+    if installer_types is None:
+        return {app.id: None for app in apps}
+    return {app.id: get_installer_lane(installer_types.get(app.id)) for app in apps}
+
+
+def upgrade_apps(apps_to_upgrade, winget_exe_path, max_workers=1, timeouts=None, installer_types=None, deadline=None):
+    """Upgrade apps using up to max_workers concurrent winget processes.
+
+    Results are returned in the order of apps_to_upgrade regardless of completion order.
+    timeouts maps package ids to the seconds their upgrade may take, see
+    get_upgrade_timeouts(). installer_types maps package ids to their installer type, see
+    get_installer_types(); when given, upgrades using Windows Installer run one at a time
+    while the others run in parallel. No upgrade is started once time.monotonic() reaches
+    deadline, and apps that weren't started have no result. With a single worker each
+    app is upgraded as soon as apps_to_upgrade yields it.
+    """
+    timeouts = {} if timeouts is None else timeouts
+    if max_workers <= 1:
+        results = [
+            run_before_deadline(deadline, upgrade_app, app, winget_exe_path, timeouts.get(app.id, DEFAULT_UPGRADE_TIMEOUT))
+            for app
+            in apps_to_upgrade
+        ]
+        return [result for result in results if result is not None]
+
+    apps_to_upgrade = list(apps_to_upgrade)
+    lanes = get_upgrade_lanes(apps_to_upgrade, installer_types)
+    with LaneExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(
+                lanes[app.id],
+                run_before_deadline,
+                deadline,
+                upgrade_app,
+                app,
+                winget_exe_path,
+                timeouts.get(app.id, DEFAULT_UPGRADE_TIMEOUT),
+            )
+            for app
+            in apps_to_upgrade
+        ]
+    return [future.result() for future in futures if future.result() is not None]
+
+
+# Details winget needs to find each source's packages when they're listed in an import file
+IMPORT_SOURCE_DETAILS = {
+    "winget": {
+        "Argument": "https://cdn.winget.microsoft.com/cache",
+        "Identifier": "Microsoft.Winget.Source_8wekyb3d8bbwe",
+        "Name": "winget",
+        "Type": "Microsoft.PreIndexed.Package",
+    },
+    "msstore": {
+        "Argument": "https://storeedgefd.dsx.mp.microsoft.com/v9.0",
+        "Identifier": "StoreEdgeFD",
+        "Name": "msstore",
+        "Type": "Microsoft.Rest",
+    },
+}
+
+
+def upgrade_apps_in_batch(
+    apps_to_upgrade, winget_exe_path, max_workers=1, source=None, timeouts=None, deadline=None,
+    installer_types=None, installer_types_path=None,
+):
+    """Upgrade apps with a single "winget import" rather than one winget process per app.
+
+    Apps from sources that can't be imported, and apps still listed as upgradable after
+    the import, are then upgraded one at a time with upgrade_apps(). Neither the import
+    nor those upgrades are started once time.monotonic() reaches deadline, and the import
+    is stopped if it's still running then. The apps upgraded one at a time are kept in
+    installer lanes by installer_types, or by the types get_installer_types() finds for
+    them using the cache at installer_types_path, see upgrade_apps().
+    """
+    apps_to_upgrade = list(apps_to_upgrade)
+    timeouts = timeouts or {}
+    batch = [app for app in apps_to_upgrade if app.source in IMPORT_SOURCE_DETAILS]
+    results_by_id = {}
+
+    if batch and (deadline is None or time.monotonic() < deadline):
+        batch_timeout = sum(timeouts.get(app.id, DEFAULT_UPGRADE_TIMEOUT) for app in batch)
+        if deadline is not None:
+            batch_timeout = min(batch_timeout, deadline - time.monotonic())
+        batch_result = run_import_batch(batch, winget_exe_path, batch_timeout)
+        try:
+            still_upgradable = {
+                app.id: app
+                for app
+                in iter_winget_upgrade_listing(winget_exe_path, source)
+            }
+        except (OSError, subprocess.CalledProcessError) as exc:
+            logging.warning(f"Unable to check which apps the batch upgraded, relying on its return code. {exc}")
+            still_upgradable = {} if batch_result["error"] is None else {app.id: app for app in batch}
+
+        upgraded = [app for app in batch if is_pinned_version_installed(app, still_upgradable)]
+        for app in upgraded:
+            result = make_upgrade_result(app)
+            result.update(
+                # The batch's return code covers every app, but this one was upgraded
+                returncode=0,
+                # The batch's duration can't be split exactly, so each app gets an equal share
+                duration=batch_result["duration"] / len(upgraded),
+                batched=True,
+            )
+            results_by_id[app.id] = result
+        logging.info(
+            f"Batch upgraded {len(upgraded)} of {len(batch)} apps in {batch_result['duration']:.1f}s "
+            # The import and the listing checking what it upgraded
+            f"using 2 winget processes instead of {len(batch)}"
+        )
+
+    fallback = [app for app in apps_to_upgrade if app.id not in results_by_id]
+    if fallback:
+        logging.info(f"Upgrading {len(fallback)} apps individually")
+        # Only the apps the import didn't upgrade need their installer types looking up
+        if installer_types is None and installer_types_path is not None and max_workers > 1:
+            installer_types = get_installer_types(fallback, winget_exe_path, installer_types_path, max_workers)
+        for result in upgrade_apps(fallback, winget_exe_path, max_workers, timeouts, installer_types, deadline):
+            results_by_id[result["id"]] = result
+
+    return [results_by_id[app.id] for app in apps_to_upgrade if app.id in results_by_id]
+
+
+def is_pinned_version_installed(app, still_upgradable):
+    """Return whether app's available version is installed, going by the applications
+    winget still lists as upgradable keyed by id.
+
+    An app that is still listed may have been upgraded to the pinned version if a newer
+    one has been published since, so the installed version it's listed with decides.
+    """
+    listed_app = still_upgradable.get(app.id)
+    if listed_app is None:
+        # Ids too wide for winget's table are truncated, so any truncated id could be app's
+        listed_app = next(
+            (
+                listed_app
+                for package_id, listed_app
+                in still_upgradable.items()
+                if package_id.endswith(TRUNCATION_MARKER)
+                and app.id.startswith(package_id[:-len(TRUNCATION_MARKER)])
+            ),
+            None,
+        )
+    if listed_app is None:
+        return True
+    if listed_app.version.endswith(TRUNCATION_MARKER):
+        return False
+    installed, pinned = listed_app.parsed_version, app.parsed_available
+    if installed is None or pinned is None:
+        return listed_app.version == app.available
+    return installed >= pinned
+
+
+def build_import_file(apps):
+    """Return the contents of a "winget import" file pinning each app to its available version."""
+    packages_by_source = {}
+    for app in apps:
+        packages_by_source.setdefault(app.source, []).append({
+            "PackageIdentifier": app.id,
+            "Version": app.available,
+        })
+    return {
+        "$schema": "https://aka.ms/winget-packages.schema.2.0.json",
+        "CreationDate": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "Sources": [
+            {
+                "Packages": packages,
+                "SourceDetails": IMPORT_SOURCE_DETAILS[source],
+            }
+            for source, packages
+            in packages_by_source.items()
+        ],
+        "WinGetVersion": "1.0.0",
+    }
+
+
+def run_import_batch(apps, winget_exe_path, timeout):
+    logging.info(f"Attempting to upgrade {len(apps)} apps in a single batch")
+    result = {"returncode": None, "duration": 0.0, "stdout": "", "stderr": "", "error": None}
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        import_file_path = os.path.join(temporary_dir, "upgrades.json")
+        with open(import_file_path, "w", encoding="utf-8") as f:
+            json.dump(build_import_file(apps), f)
+
+        start = time.perf_counter()
+        try:
+            completed_process = subprocess.run([
+                    winget_exe_path,
+                    "import",
+                    "--import-file",
+                    import_file_path,
+                    "--ignore-unavailable",
+                    "--accept-package-agreements",
+                    "--accept-source-agreements",
+                ], timeout=timeout, capture_output=True
+            )
+            result["returncode"] = completed_process.returncode
+            result["stdout"] = decode_output(completed_process.stdout)
+            result["stderr"] = decode_output(completed_process.stderr)
+            if completed_process.returncode != 0:
+                result["error"] = f"winget returned {completed_process.returncode}"
+                logging.warning(f"Batch upgrade returned {completed_process.returncode}, some apps may not have been upgraded")
+        except FileNotFoundError as exc:
+            result["error"] = "executable not found"
+            logging.error(f"Process failed to run the batch upgrade because the executable could not be found.")
+        except subprocess.TimeoutExpired as exc:
+            result["error"] = TIMED_OUT_ERROR
+            logging.error(f"Process timed out whilst running the batch upgrade.\n{exc}")
+        finally:
+            result["duration"] = time.perf_counter() - start
+
+    return result
+
+
+# Exit codes meaning an MSI (or a bundle of them) installed but a restart is needed to finish
+MSI_RESTART_CODES = (1641, 3010)
+# ExpectedReturnCodes responses with which winget counts an install as having succeeded
+SUCCESSFUL_RETURN_RESPONSES = ("rebootRequiredToFinish", "rebootInitiated")
+# Silent switches winget passes to each type of installer when the manifest doesn't give any
+DEFAULT_SILENT_SWITCHES = {
+    "burn": "/quiet /norestart",
+    "inno": "/SP- /VERYSILENT /SUPPRESSMSGBOXES /NORESTART",
+    "nullsoft": "/S",
+}
+
+
+def upgrade_apps_with_prefetch(
+    apps_to_upgrade, winget_exe_path, download_dir, max_workers=1, download_workers=4, timeouts=None,
+    installer_types=None, installer_cache=None, deadline=None,
+):
+    """Download the installers of apps ahead of time and install them as they become ready.
+
+    Up to download_workers "winget download" processes run at the same time as up to
+    max_workers installs, so the network isn't idle while installers run and vice versa.
+    Apps whose installer couldn't be downloaded, or can't be run silently without winget,
+    are upgraded with "winget upgrade" instead. Results are returned in the order of
+    apps_to_upgrade. Installs are run in lanes by installer type, see upgrade_apps().
+    Installers are shared with other hosts through installer_cache, see InstallerCache.
+    No download or install is started once time.monotonic() reaches deadline.
+    """
+    apps_to_upgrade = list(apps_to_upgrade)
+    timeouts = timeouts or {}
+    lanes = get_upgrade_lanes(apps_to_upgrade, installer_types)
+    downloaded = queue.Queue()
+    results_by_id = {}
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_executor:
+        for app in apps_to_upgrade:
+            future = download_executor.submit(
+                run_before_deadline,
+                deadline,
+                download_installer,
+                app,
+                winget_exe_path,
+                download_dir,
+                timeouts.get(app.id, DEFAULT_UPGRADE_TIMEOUT),
+                installer_cache,
+            )
+            future.add_done_callback(lambda future, app=app: downloaded.put((app, future)))
+
+        with LaneExecutor(max_workers) as install_executor:
+            install_futures = [
+                install_executor.submit(
+                    lanes[app.id],
+                    install_downloaded_app,
+                    app,
+                    get_download_result(app, future, download_dir),
+                    winget_exe_path,
+                    timeouts.get(app.id, DEFAULT_UPGRADE_TIMEOUT),
+                    deadline,
+                )
+                for app, future
+                in (downloaded.get() for _ in apps_to_upgrade)
+            ]
+            for future in install_futures:
+                result = future.result()
+                if result is not None:
+                    results_by_id[result["id"]] = result
+
+    return [results_by_id[app.id] for app in apps_to_upgrade if app.id in results_by_id]
+
+
+def download_installer(app, winget_exe_path, download_dir, timeout=DEFAULT_UPGRADE_TIMEOUT, installer_cache=None):
+    """Download the installer and manifest of app's available version with "winget download".
+
+    With an installer_cache, the installer's SHA256 and type are read from "winget show"
+    and the installer is copied from the cache if it holds one matching the SHA256,
+    otherwise it is downloaded, checked against the SHA256 and added to the cache. Only
+    types that can be run silently without a manifest are cached, see
+    can_run_without_manifest().
+
+    Returns a dict holding the directory they were downloaded to, the installer type when
+    it was copied from the cache, which has no manifest, how long that took and an error,
+    which is None if the download succeeded.
+    """
+    download = {
+        "path": get_download_path(download_dir, app),
+        "installer_type": None,
+        "duration": 0.0,
+        "error": None,
+    }
+    start = time.perf_counter()
+    sha256 = None
+    cacheable = False
+    if installer_cache is not None:
+        show_output = show_installer(app, winget_exe_path)
+        sha256 = parse_installer_sha256(show_output)
+        installer_type = parse_installer_type(show_output)
+        cacheable = sha256 is not None and can_run_without_manifest(installer_type)
+        if cacheable and installer_cache.fetch(app.id, app.available, sha256, download["path"]):
+            logging.info(f"Using the cached installer of {app.id} {app.available}")
+            download["installer_type"] = installer_type
+            download["duration"] = time.perf_counter() - start
+            return download
+
+    logging.info(f"Downloading the installer of {app.id} {app.available}")
+    try:
+        completed_process = subprocess.run([
+                winget_exe_path,
+                "download",
+                "--id",
+                app.id,
+                "--version",
+                app.available,
+                "--download-directory",
+                download["path"],
+                "--accept-package-agreements",
+                "--accept-source-agreements",
+            ], timeout=timeout, capture_output=True
+        )
+        if completed_process.returncode != 0:
+            download["error"] = f"winget returned {completed_process.returncode}"
+    except FileNotFoundError as exc:
+        download["error"] = "executable not found"
+    except subprocess.TimeoutExpired as exc:
+        download["error"] = TIMED_OUT_ERROR
+    finally:
+        download["duration"] = time.perf_counter() - start
+
+    if download["error"] is None and sha256 is not None:
+        installer_path = find_installer_path(download["path"])
+        if installer_path is None or hash_file(installer_path) != sha256:
+            download["error"] = "installer hash mismatch"
+        elif cacheable:
+            installer_cache.publish(app.id, app.available, sha256, installer_path)
+
+    if download["error"] is not None:
+        logging.warning(f"Unable to download the installer of '{app.id}', {download['error']}")
+    return download
+
+
+def get_download_result(app, future, download_dir):
+    """Return the result of download_installer(), as a failed download if it raised or
+    wasn't started before the deadline."""
+    error = "not started before the deadline"
+    try:
+        download = future.result()
+        if download is not None:
+            return download
+    except Exception as exc:
+        logging.warning(f"Unable to download the installer of '{app.id}'. {exc}")
+        error = str(exc)
+    return {
+        "path": get_download_path(download_dir, app),
+        "installer_type": None,
+        "duration": 0.0,
+        "error": error,
+    }
+
+
+def get_download_path(download_dir, app):
+    return os.path.join(download_dir, f"{app.id}_{app.available}")
+
+
+def install_downloaded_app(app, download, winget_exe_path, timeout=DEFAULT_UPGRADE_TIMEOUT, deadline=None):
+    """Upgrade app by running the installer download_installer() downloaded.
+
+    Falls back to "winget upgrade" if the download failed or the installer can't be run
+    silently without winget. The downloaded files are removed afterwards. Returns None
+    without upgrading app if time.monotonic() has reached deadline.
+    """
+    try:
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        command = None
+        if download["error"] is None:
+            command = get_installer_command(download["path"], download["installer_type"])
+            if command is None:
+                logging.info(f"Unable to run the installer of '{app.id}' silently without winget")
+
+        if command is None:
+            result = upgrade_app(app, winget_exe_path, timeout)
+        else:
+            installer_type, args = command
+            logging.info(f'Attempting to upgrade {app.id} from version {app.version} to {app.available} using its downloaded {installer_type} installer')
+            success_codes = get_installer_success_codes(download["path"], installer_type, download["installer_type"] is None)
+            result = run_upgrade_process(app, args, timeout, "installer", success_codes)
+            result["prefetched"] = True
+    finally:
+        shutil.rmtree(download["path"], ignore_errors=True)
+
+    result["download_duration"] = download["duration"]
+    result["duration"] += download["duration"]
+    return result
+
+
+def can_run_without_manifest(installer_type):
+    """Return whether an installer of installer_type has default silent switches, so it
+    can be run from an InstallerCache, which doesn't keep manifests."""
+    return installer_type in ("msi", "wix") or installer_type in DEFAULT_SILENT_SWITCHES
+
+
+def get_installer_command(download_path, installer_type=None):
+    """Return the installer type and the command to run the installer in download_path silently.
+
+    The type and switches are read from the manifest "winget download" wrote alongside the
+    installer. When installer_type is given, the installer came from an InstallerCache
+    without a manifest, so only the default switches for that type are used.
+    Returns None if there is no installer, or its type has no known silent switches.
+    """
+    installer_path = find_installer_path(download_path)
+    if installer_path is None:
+        return None
+    if installer_type is not None:
+        manifest = {"InstallerType": installer_type}
+    else:
+        manifest_path = find_manifest_path(download_path)
+        manifest = read_manifest_values(manifest_path) if manifest_path is not None else {}
+    installer_type = manifest.get("InstallerType", "").lower()
+    if not installer_type and installer_path.lower().endswith(".msi"):
+        installer_type = "msi"
+    custom_switches = manifest.get("Custom", "").split()
+
+    if installer_type in ("msi", "wix"):
+        return installer_type, ["msiexec", "/i", installer_path, "/qn", "/norestart"] + custom_switches
+    if installer_type in ("exe", "burn", "inno", "nullsoft"):
+        silent_switches = (
+            manifest.get("Silent")
+            or manifest.get("SilentWithProgress")
+            or DEFAULT_SILENT_SWITCHES.get(installer_type)
+        )
+        if silent_switches:
+            return installer_type, [installer_path] + silent_switches.split() + custom_switches
+    # Other types (msix, zip, portable, ...) need winget to install them
+    return None
+
+
+def get_installer_success_codes(download_path, installer_type, has_manifest=True):
+    """Return the exit codes with which the downloaded installer in download_path succeeded.
+
+    Besides 0, these are the codes its manifest lists, see read_manifest_success_codes(),
+    and for Windows Installer types the codes asking for a restart, as winget expects.
+    Installers copied from an InstallerCache have no manifest, so has_manifest is False.
+    """
+    success_codes = {0}
+    if installer_type in WINDOWS_INSTALLER_TYPES:
+        success_codes.update(MSI_RESTART_CODES)
+    manifest_path = find_manifest_path(download_path) if has_manifest else None
+    if manifest_path is not None:
+        for code in read_manifest_success_codes(manifest_path):
+            # Windows reports exit codes as unsigned, manifests often list them signed
+            success_codes.update((code, code & 0xFFFFFFFF))
+    return tuple(sorted(success_codes))
+
+
+def find_installer_path(download_path):
+    """Return the path of the installer "winget download" wrote to download_path, or None
+    if there isn't exactly one."""
+    try:
+        installer_names = [name for name in os.listdir(download_path) if not name.lower().endswith(".yaml")]
+    except OSError:
+        return None
+    return os.path.join(download_path, installer_names[0]) if len(installer_names) == 1 else None
+
+
+def find_manifest_path(download_path):
+    try:
+        manifest_names = sorted(name for name in os.listdir(download_path) if name.lower().endswith(".yaml"))
+    except OSError:
+        return None
+    return os.path.join(download_path, manifest_names[0]) if manifest_names else None
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class InstallerCache:
+    """Downloaded installers shared between hosts, keyed by package id, version and SHA256.
+
+    The directory can be on a network share. Each entry is a directory holding only an
+    installer, published by renaming a complete copy into place so other hosts never see a
+    partial entry. Manifests aren't shared, since their switches would be run as is. An
+    installer is checked against its SHA256 after it has been copied out of the cache, and
+    the least recently used are evicted once they take up more than max_size bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def get_entry_path(self, package_id, version, sha256):
+        return os.path.join(self.path, quote_path_component(package_id), quote_path_component(version), sha256)
+
+    def fetch(self, package_id, version, sha256, download_path):
+        """Copy the cached installer into download_path, returning whether there was one
+        matching sha256."""
+        entry_path = self.get_entry_path(package_id, version, sha256)
+        cached_installer_path = find_installer_path(entry_path)
+        if cached_installer_path is None:
+            return False
+        installer_path = os.path.join(download_path, os.path.basename(cached_installer_path))
+        try:
+            shutil.rmtree(download_path, ignore_errors=True)
+            os.makedirs(download_path)
+            shutil.copy(cached_installer_path, installer_path)
+            # The copy is what gets run, so it's the copy that's checked
+            if hash_file(installer_path) != sha256:
+                logging.warning(f"Removing the cached installer of '{package_id}' {version}, its hash doesn't match")
+                shutil.rmtree(download_path, ignore_errors=True)
+                shutil.rmtree(entry_path, ignore_errors=True)
+                return False
+            # Entries are evicted least recently used first
+            os.utime(entry_path)
+        except OSError as exc:
+            logging.warning(f"Unable to use the cached installer of '{package_id}' {version}. {exc}")
+            shutil.rmtree(download_path, ignore_errors=True)
+            return False
+        return True
+
+    def publish(self, package_id, version, sha256, installer_path):
+        """Add the installer at installer_path, unless another host already has."""
+        entry_path = self.get_entry_path(package_id, version, sha256)
+        if os.path.isdir(entry_path):
+            return
+        temporary_path = f"{entry_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(temporary_path)
+            shutil.copy(installer_path, os.path.join(temporary_path, os.path.basename(installer_path)))
+            os.rename(temporary_path, entry_path)
+        except OSError as exc:
+            # Most likely another host published the same installer first
+            logging.debug(f"[-] Unable to add the installer of '{package_id}' {version} to the installer cache. {exc}")
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        # Other hosts add and evict entries at the same time, so any of them may disappear
+        # while they're being looked at
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(self.path, onerror=lambda exc: None):
+            # Entries are the directories three levels down: package id, version and SHA256
+            if os.path.relpath(dir_path, self.path).count(os.sep) == 1:
+                for dir_name in dir_names:
+                    if not dir_name.endswith(".tmp"):
+                        entry_path = os.path.join(dir_path, dir_name)
+                        try:
+                            entries.append((os.path.getmtime(entry_path), get_directory_size(entry_path), entry_path))
+                        except OSError:
+                            continue
+                dir_names.clear()
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logging.debug(f"[-] Evicting '{entry_path}' from the installer cache")
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
+            # Remove the version and package id directories too once they're empty
+            try:
+                os.rmdir(os.path.dirname(entry_path))
+                os.rmdir(os.path.dirname(os.path.dirname(entry_path)))
+            except OSError:
+                pass
+
+
+def quote_path_component(value):
+    return re.sub(r'[<>:"/\\|?*]', "_", value)
+
+
+def get_directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dir_path, file_name))
+        for dir_path, _, file_names
+        in os.walk(path)
+        for file_name
+        in file_names
+    )
+
+
+def read_manifest_values(path):
+    """Return the first value of each "Key: value" line of a winget manifest.
+
+    Downloaded manifests describe a single installer, so this is enough to read its type
+    and switches without a YAML parser.
+    """
+    values = {}
+    try:
+        with open(path, encoding="utf-8-sig") as f:
+            for line in f:
+                key, separator, value = line.strip().lstrip("- ").partition(":")
+                value = value.split(" #", 1)[0].strip().strip("'\"")
+                if separator and value and " " not in key and key not in values:
+                    values[key] = value
+    except OSError as exc:
+        logging.warning(f"Unable to read manifest '{path}'. {exc}")
+    return values
+
+
+def read_manifest_success_codes(path):
+    """Return the exit codes a winget manifest's installer succeeds with, besides 0.
+
+    These are its InstallerSuccessCodes and its ExpectedReturnCodes whose ReturnResponse
+    is in SUCCESSFUL_RETURN_RESPONSES. Like read_manifest_values(), only the layout winget
+    writes is read, with each list item on its own line.
+    """
+    codes = []
+    expected_return_codes = []
+    list_key = list_indent = None
+    try:
+        with open(path, encoding="utf-8-sig") as f:
+            for line in f:
+                text = line.split(" #", 1)[0].rstrip()
+                content = text.lstrip()
+                if not content:
+                    continue
+                indent = len(text) - len(content)
+                is_item = content.startswith("- ")
+                if list_key is not None and indent <= list_indent and not is_item:
+                    list_key = None
+                key, separator, value = content[2:].partition(":") if is_item else content.partition(":")
+                value = value.strip().strip("'\"")
+                if key in ("InstallerSuccessCodes", "ExpectedReturnCodes") and separator and not is_item:
+                    list_key, list_indent = key, indent
+                    if key == "InstallerSuccessCodes" and value:
+                        # Written inline, e.g. [3010, 1641]
+                        codes.extend(value.strip("[]").split(","))
+                elif list_key == "InstallerSuccessCodes" and is_item:
+                    codes.append(content[2:])
+                elif list_key == "ExpectedReturnCodes" and separator:
+                    if is_item:
+                        expected_return_codes.append({})
+                    if expected_return_codes:
+                        expected_return_codes[-1][key.strip()] = value
+    except OSError as exc:
+        logging.warning(f"Unable to read manifest '{path}'. {exc}")
+
+    codes.extend(
+        expected_return_code.get("InstallerReturnCode", "")
+        for expected_return_code
+        in expected_return_codes
+        if expected_return_code.get("ReturnResponse") in SUCCESSFUL_RETURN_RESPONSES
+    )
+    success_codes = []
+    for code in codes:
+        try:
+            success_codes.append(int(code.strip().strip("'\"")))
+        except ValueError:
+            logging.warning(f"Ignoring invalid success code {code.strip()!r} in manifest '{path}'")
+    return success_codes
+
+
+PLAN_VERSION = 1
+PLAN_COLUMNS = APPLICATION_COLUMNS + ("Timeout",)
+
+
+class UpgradePlan(NamedTuple):
+    created: float
+    # In the order they are to be upgraded
+    apps: list
+    timeouts: dict
+    # None unless installer types were looked up, see get_installer_types()
+    installer_types: Optional[dict]
+    skipped: list
+
+
+def write_upgrade_plan(path, apps, timeouts, installer_types=None, skipped=()):
+    """Write the upgrades of apps, in order, to a plan file read by read_upgrade_plan()."""
+    write_json_atomically(path, {
+        "version": PLAN_VERSION,
+        "created": time.time(),
+        "columns": PLAN_COLUMNS,
+        "apps": [
+            [*app[:len(APPLICATION_COLUMNS)], timeouts.get(app.id, DEFAULT_UPGRADE_TIMEOUT)]
+            for app
+            in apps
+        ],
+        "installer_types": installer_types,
+        "skipped": list(skipped),
+    })
+
+
+def read_upgrade_plan(path):
+    with open(path, encoding="utf-8") as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported upgrade plan version {plan.get('version')!r} in '{path}'")
+
+    apps = [Application(*row[:len(APPLICATION_COLUMNS)]) for row in plan["apps"]]
+    return UpgradePlan(
+        created=plan["created"],
+        apps=apps,
+        timeouts={app.id: row[len(APPLICATION_COLUMNS)] for app, row in zip(apps, plan["apps"])},
+        installer_types=plan["installer_types"],
+        skipped=plan["skipped"],
+    )
+
+
+def build_upgrade_report(results, skipped=(), failure_rates=None):
+    """Summarise results and skipped upgrades. failure_rates, from
+    HistoryStore.get_failure_rates(), adds the recent failure rate of each package that
+    was attempted or skipped."""
+    failed = [result for result in results if result["error"] is not None]
+    report = {
+        "attempted": len(results),
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "skipped": len(skipped),
+        "total_duration": sum(result["duration"] for result in results),
+        "results": results,
+        "skipped_results": list(skipped),
+    }
+    if failure_rates is not None:
+        report["failure_rates"] = {
+            package_id: failure_rates[package_id]
+            for package_id
+            in [result["id"] for result in results] + [entry["id"] for entry in skipped]
+            if package_id in failure_rates
+        }
+    return report
+
+
+def write_upgrade_report(report, report_path):
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def schedule_longest_first(apps_to_upgrade, expected_durations, default_duration):
+    """Order apps by expected upgrade duration, longest first.
+
+    Workers take apps in order as they become free, so starting the longest upgrades
+    first keeps a long one from being left to run alone at the end.
+    """
+    return sorted(
+        apps_to_upgrade,
+        key=lambda app: expected_durations.get(app.id, default_duration),
+        reverse=True,
+    )
+
+
+def estimate_makespan(durations, max_workers):
+    """Return how long running durations in order across max_workers workers is expected to take."""
+    workers = [0.0] * max(max_workers, 1)
+    for duration in durations:
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers)
+
+
+# How much upgrading an app is worth by the kind of upgrade, see classify_upgrade(). Patch
+# releases are the most likely to carry security fixes and the least likely to break things.
+UPGRADE_KIND_VALUES = {"patch": 3, "minor": 2, "major": 1, "unknown": 1, "unparsed": 1}
+# How many times more upgrading an app in get_security_updates() is worth
+SECURITY_UPDATE_WEIGHT = 10
+# Durations are rounded to steps of budget / DEADLINE_STEPS so choosing stays quick
+DEADLINE_STEPS = 10000
+
+
+def get_upgrade_value(app, priorities, security_updates):
+    value = priorities.get(app.id, 1) * UPGRADE_KIND_VALUES[classify_upgrade(app) or "unparsed"]
+    if app.id in security_updates:
+        value *= SECURITY_UPDATE_WEIGHT
+    return value
+
+
+def select_within_deadline(apps_to_upgrade, budget, expected_durations, default_duration, max_workers=1):
+    """Choose the apps worth the most to upgrade that are expected to finish within budget seconds.
+
+    The value of upgrading each app comes from get_upgrade_value(), and the total expected
+    duration of the chosen apps is limited to budget for each worker (a 0/1 knapsack). Apps
+    are then dropped, least value per second first, until running them longest first is
+    expected to finish within budget. Returns the chosen apps, ordered to be upgraded, and
+    the rest.
+    """
+    apps_to_upgrade = list(apps_to_upgrade)
+    priorities = get_upgrade_priorities()
+    security_updates = get_security_updates()
+    values = [get_upgrade_value(app, priorities, security_updates) for app in apps_to_upgrade]
+    durations = [expected_durations.get(app.id, default_duration) for app in apps_to_upgrade]
+
+    chosen = choose_within_capacity(values, durations, budget * max(max_workers, 1))
+    by_value_per_second = sorted(chosen, key=lambda i: values[i] / max(durations[i], 1e-9), reverse=True)
+    while by_value_per_second and estimate_makespan(
+        sorted((durations[i] for i in by_value_per_second), reverse=True), max_workers
+    ) > budget:
+        by_value_per_second.pop()
+
+    chosen = set(by_value_per_second)
+    if max_workers > 1:
+        order = sorted(chosen, key=lambda i: durations[i], reverse=True)
+    else:
+        # If upgrades overrun, the ones left unstarted are worth the least
+        order = by_value_per_second
+    return (
+        [apps_to_upgrade[i] for i in order],
+        [app for i, app in enumerate(apps_to_upgrade) if i not in chosen],
+    )
+
+
+def choose_within_capacity(values, durations, capacity):
+    """Return the indexes of the items with the most total value whose durations add up to
+    at most capacity."""
+    step = max(capacity / DEADLINE_STEPS, 1e-9)
+    steps = int(capacity / step)
+    weights = [math.ceil(duration / step) for duration in durations]
+
+    best = [0] * (steps + 1)
+    # taken[i][w] records whether item i is in the best choice with w steps to spare
+    taken = []
+    for value, weight in zip(values, weights):
+        taken_here = bytearray(steps + 1)
+        for w in range(steps, weight - 1, -1):
+            if best[w - weight] + value > best[w]:
+                best[w] = best[w - weight] + value
+                taken_here[w] = 1
+        taken.append(taken_here)
+
+    chosen = []
+    w = steps
+    for i in range(len(values) - 1, -1, -1):
+        if taken[i][w]:
+            chosen.append(i)
+            w -= weights[i]
+    return chosen[::-1]
+
+
+def run_before_deadline(deadline, fn, *args):
+    """Return fn(*args), or None without calling it if time.monotonic() has reached deadline."""
+    if deadline is not None and time.monotonic() >= deadline:
+        return None
+    return fn(*args)
+
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    package_id TEXT NOT NULL,
+    from_version TEXT NOT NULL,
+    to_version TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INTEGER,
+    error TEXT,
+    output_bytes INTEGER NOT NULL,
+    batched INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_package_id ON attempts(package_id);
+CREATE TABLE IF NOT EXISTS listings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    package_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    available TEXT NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_run_id ON listings(run_id);
+"""
+
+# Applied in order to bring a database created with HISTORY_SCHEMA up to date, the
+# database's user_version records how many have been applied
+HISTORY_MIGRATIONS = (
+    "ALTER TABLE attempts ADD COLUMN timeout REAL",
+)
+
+# Buffered rows are written once this many have built up, and when the run finishes
+HISTORY_BATCH_SIZE = 500
+
+# Statistics for each package are based on this many of its most recent attempts
+HISTORY_WINDOW = 20
+
+# Listings are kept for this many of the most recent runs, older ones are deleted
+HISTORY_LISTING_RUNS = 10
+
+
+class HistoryStore:
+    """Records runs, their phase timings, upgrade attempts and listings in a SQLite database.
+
+    Rows are buffered in memory and written in batches, so recording can be done from
+    any thread without waiting on the database.
+    """
+
+    def __init__(self, history_path):
+        self._connection = sqlite3.connect(history_path, check_same_thread=False)
+        self._connection.executescript(HISTORY_SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+        self._pending = {"phases": [], "attempts": [], "listings": []}
+        self._pending_count = 0
+        self.run_id = None
+
+    def _migrate(self):
+        applied, = self._connection.execute("PRAGMA user_version").fetchone()
+        with self._connection:
+            for migration in HISTORY_MIGRATIONS[applied:]:
+                self._connection.execute(migration)
+            self._connection.execute(f"PRAGMA user_version = {len(HISTORY_MIGRATIONS)}")
+
+    def start_run(self):
+        with self._lock, self._connection:
+            self.run_id = self._connection.execute(
+                "INSERT INTO runs(started_at) VALUES (?)", (time.time(),)
+            ).lastrowid
+
+    def finish_run(self):
+        self.flush()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE runs SET finished_at = ? WHERE id = ?", (time.time(), self.run_id)
+            )
+            self._connection.execute("""
+                DELETE FROM listings
+                WHERE run_id NOT IN (SELECT id FROM runs ORDER BY id DESC LIMIT ?)
+            """, (HISTORY_LISTING_RUNS,))
+
+    def close(self):
+        self._connection.close()
+
+    def record_phase(self, name, duration):
+        self._buffer("phases", [(self.run_id, name, duration)])
+
+    def record_attempt(self, result):
+        self._buffer("attempts", [(
+            self.run_id,
+            result["id"],
+            result["version"],
+            result["available"],
+            result["started_at"],
+            result["duration"],
+            result["returncode"],
+            result["error"],
+            len(result["stdout"].encode("utf-8")) + len(result["stderr"].encode("utf-8")),
+            result["batched"],
+            result["timeout"],
+        )])
+
+    def iter_recording_listing(self, applications):
+        """Yield applications as they're listed, recording each as part of this run's listing."""
+        for app in applications:
+            self.record_listing((app,))
+            yield app
+
+    def record_listing(self, applications):
+        self._buffer("listings", [
+            (self.run_id, app.id, app.name, app.version, app.available, app.source)
+            for app
+            in applications
+        ])
+
+    def _buffer(self, table, rows):
+        with self._lock:
+            self._pending[table].extend(rows)
+            self._pending_count += len(rows)
+            should_flush = self._pending_count >= HISTORY_BATCH_SIZE
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock, self._connection:
+            for table, rows in self._pending.items():
+                if rows:
+                    placeholders = ", ".join("?" * len(rows[0]))
+                    self._connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+                    rows.clear()
+            self._pending_count = 0
+
+    def _recent_attempts(self, columns, where=""):
+        with self._lock:
+            return self._connection.execute(f"""
+                SELECT package_id, {columns}
+                FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY package_id ORDER BY started_at DESC) AS recency
+                    FROM attempts
+                    WHERE NOT batched {where}
+                )
+                WHERE recency <= ?
+            """, (HISTORY_WINDOW,)).fetchall()
+
+    def get_duration_percentiles(self, percent, min_samples=1):
+        """Return the percent percentile of each package's recent successful upgrade durations,
+        for packages with at least min_samples of them."""
+        durations_by_id = {}
+        for package_id, duration in self._recent_attempts("duration", "AND error IS NULL"):
+            durations_by_id.setdefault(package_id, []).append(duration)
+        return {
+            package_id: get_percentile(sorted(durations), percent)
+            for package_id, durations
+            in durations_by_id.items()
+            if len(durations) >= min_samples
+        }
+
+    def get_consecutive_failures(self):
+        """Return (failure count, time the last failure finished) for each package id and target
+        version whose upgrade has failed since it last succeeded."""
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT package_id, to_version, COUNT(*), MAX(started_at + duration)
+                FROM attempts AS failed
+                WHERE error IS NOT NULL AND started_at > COALESCE((
+                    SELECT MAX(started_at)
+                    FROM attempts AS succeeded
+                    WHERE succeeded.package_id = failed.package_id
+                        AND succeeded.to_version = failed.to_version
+                        AND succeeded.error IS NULL
+                ), 0)
+                GROUP BY package_id, to_version
+            """).fetchall()
+        return {
+            (package_id, to_version): (failures, last_failed_at)
+            for package_id, to_version, failures, last_failed_at
+            in rows
+        }
+
+    def get_timed_out_timeouts(self):
+        """Return the timeout applied to each package whose most recent upgrade attempt timed out."""
+        with self._lock:
+            return dict(self._connection.execute("""
+                SELECT package_id, timeout
+                FROM (
+                    SELECT package_id, timeout, error,
+                        ROW_NUMBER() OVER (PARTITION BY package_id ORDER BY started_at DESC) AS recency
+                    FROM attempts
+                    WHERE NOT batched
+                )
+                WHERE recency = 1 AND error = ? AND timeout IS NOT NULL
+            """, (TIMED_OUT_ERROR,)).fetchall())
+
+    def get_failure_rates(self):
+        """Return the fraction of each package's recent upgrade attempts that failed."""
+        outcomes_by_id = {}
+        for package_id, failed in self._recent_attempts("error IS NOT NULL"):
+            outcomes_by_id.setdefault(package_id, []).append(failed)
+        return {
+            package_id: sum(outcomes) / len(outcomes)
+            for package_id, outcomes
+            in outcomes_by_id.items()
+        }
+
+
+def get_percentile(sorted_values, percent):
+    """Return the percent percentile of sorted_values, interpolating between the closest ranks."""
+    rank = (len(sorted_values) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def open_history_store(history_path):
+    try:
+        return HistoryStore(history_path)
+    except sqlite3.Error as exc:
+        logging.warning(f"Unable to open run history '{history_path}', this run won't be recorded. {exc}")
+        return None
+
+
+# Timeouts are only derived from a package's history once it has this many successful upgrades
+TIMEOUT_MIN_SAMPLES = 3
+
+
+def get_timeout_overrides():
+    """Seconds that upgrading particular package ids may take, regardless of their history."""
+    return {
+        # 'Microsoft.VisualStudio.2022.Community': 3600,
+    }
+
+
+def get_upgrade_timeouts(apps_to_upgrade, history, default_timeout, headroom, floor, ceiling):
+    """Return the timeout in seconds for upgrading each app keyed by package id, see
+    iter_upgrade_timeouts()."""
+    return {
+        app.id: timeout
+        for app, timeout
+        in iter_upgrade_timeouts(apps_to_upgrade, history, default_timeout, headroom, floor, ceiling)
+    }
+
+
+def iter_with_upgrade_timeouts(apps_to_upgrade, timeouts, history, default_timeout, headroom, floor, ceiling):
+    """Yield apps_to_upgrade as they arrive, once the timeout of each has been added to
+    timeouts, see iter_upgrade_timeouts()."""
+    for app, timeout in iter_upgrade_timeouts(apps_to_upgrade, history, default_timeout, headroom, floor, ceiling):
+        timeouts[app.id] = timeout
+        yield app
+
+
+def iter_upgrade_timeouts(apps_to_upgrade, history, default_timeout, headroom, floor, ceiling):
+    """Yield each app with the timeout in seconds for upgrading it.
+
+    Timeouts are the 95th percentile of a package's recent successful upgrade durations
+    multiplied by headroom, or default_timeout without enough history. A package whose
+    last upgrade timed out gets at least that timeout multiplied by headroom. Either way
+    the timeout is kept between floor and ceiling. Timeouts from get_timeout_overrides()
+    are used as is.
+    """
+    if history is not None:
+        p95_durations = history.get_duration_percentiles(95, min_samples=TIMEOUT_MIN_SAMPLES)
+        timed_out_timeouts = history.get_timed_out_timeouts()
+    else:
+        p95_durations, timed_out_timeouts = {}, {}
+    overrides = get_timeout_overrides()
+
+    for app in apps_to_upgrade:
+        if app.id in overrides:
+            yield app, overrides[app.id]
+            continue
+        if app.id in p95_durations:
+            timeout = p95_durations[app.id] * headroom
+        else:
+            timeout = default_timeout
+        if app.id in timed_out_timeouts:
+            timeout = max(timeout, timed_out_timeouts[app.id] * headroom)
+        yield app, min(max(timeout, floor), ceiling)
+
+
+# The longest a package that keeps failing is skipped for between attempts
+CIRCUIT_BREAKER_MAX_BACKOFF = 30 * 24 * 60 * 60
+
+
+def apply_circuit_breaker(apps_to_upgrade, history, threshold, backoff, skipped):
+    """Yield the apps to attempt as they arrive, adding apps whose upgrades to their
+    available version keep failing to skipped instead.
+
+    After threshold consecutive failures a package is skipped for backoff seconds after its
+    last failure, doubling with each further failure. A new available version starts with
+    a clean slate. A threshold of 0 disables the breaker.
+    """
+    if history is None or threshold <= 0:
+        yield from apps_to_upgrade
+        return
+
+    consecutive_failures = history.get_consecutive_failures()
+    now = time.time()
+    for app in apps_to_upgrade:
+        failures, last_failed_at = consecutive_failures.get((app.id, app.available), (0, 0))
+        if failures >= threshold:
+            retry_after = last_failed_at + min(backoff * 2 ** (failures - threshold), CIRCUIT_BREAKER_MAX_BACKOFF)
+            if now < retry_after:
+                logging.info(
+                    f"Skipping {app.id} {app.available} after {failures} consecutive failed upgrades, "
+                    f"retrying after {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(retry_after))}"
+                )
+                skipped.append({
+                    "id": app.id,
+                    "available": app.available,
+                    "reason": "circuit_breaker",
+                    "consecutive_failures": failures,
+                    "retry_after": retry_after,
+                })
+                continue
+        yield app
+
+
+class PhaseTimer:
+    """Measures how long each phase of a run and each upgrade takes.
+
+    Uses time.perf_counter(), a monotonic high resolution clock, so measurements aren't
+    affected by changes to the system clock.
+    """
+
+    def __init__(self, allocation_tracer=None):
+        self.allocation_tracer = allocation_tracer
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.started_at = time.time()
+        self.phases = []
+        self.upgrades = []
+
+    @contextmanager
+    def phase(self, name):
+        snapshot = self.allocation_tracer.take_snapshot(name) if self.allocation_tracer is not None else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+            if snapshot is not None:
+                self.allocation_tracer.compare_snapshot(name, snapshot)
+
+    def iter_phase(self, name, iterable):
+        """Yield from iterable, recording the time spent waiting for its items as phase name.
+
+        Used when a phase overlaps the ones consuming its items, so only its own time counts.
+        """
+        iterator = iter(iterable)
+        duration = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    duration += time.perf_counter() - start
+                yield item
+        finally:
+            self.record_phase(name, duration)
+
+    def record_phase(self, name, duration):
+        with self._lock:
+            self.phases.append((name, duration))
+
+    def record_upgrade(self, result):
+        with self._lock:
+            self.upgrades.append((result["id"], result["error"] is None, result["duration"]))
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def summary(self):
+        return {
+            "started_at": self.started_at,
+            "total_duration": self.elapsed(),
+            "phases": [
+                {"phase": name, "duration": duration}
+                for name, duration
+                in self.phases
+            ],
+            "upgrades": [
+                {"id": package_id, "succeeded": succeeded, "duration": duration}
+                for package_id, succeeded, duration
+                in self.upgrades
+            ],
+        }
+
+
+# The phases that parse and filter the listing, whose allocations are traced
+TRACED_PHASES = ("listing", "selection")
+
+
+class AllocationTracer:
+    """Reports the lines allocating the most memory during each traced phase, using tracemalloc."""
+
+    def __init__(self, top_n, phases=TRACED_PHASES):
+        self.top_n = top_n
+        self.phases = phases
+        self.phase_statistics = []
+        tracemalloc.start()
+
+    def take_snapshot(self, phase):
+        if phase not in self.phases:
+            return None
+        return self._take_snapshot()
+
+    def compare_snapshot(self, phase, snapshot):
+        statistics = self._take_snapshot().compare_to(snapshot, "lineno")
+        self.phase_statistics.append((phase, statistics[:self.top_n]))
+
+    def _take_snapshot(self):
+        # Leave out the memory tracemalloc uses to take the previous snapshots
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def report(self):
+        lines = []
+        for phase, statistics in self.phase_statistics:
+            lines.append(f"Top {len(statistics)} allocations during {phase}:")
+            lines.extend(f"  {statistic}" for statistic in statistics)
+        return lines
+
+
+def write_timings_json(summary, path):
+    write_json_atomically(path, summary)
+
+
+def write_timings_prometheus(summary, path):
+    """Write summary in the Prometheus text format, for node_exporter's textfile collector."""
+    lines = [
+        "# HELP pywingetupgrader_last_run_timestamp_seconds When the last run started.",
+        "# TYPE pywingetupgrader_last_run_timestamp_seconds gauge",
+        f"pywingetupgrader_last_run_timestamp_seconds {summary['started_at']}",
+        "# HELP pywingetupgrader_run_duration_seconds How long the last run took.",
+        "# TYPE pywingetupgrader_run_duration_seconds gauge",
+        f"pywingetupgrader_run_duration_seconds {summary['total_duration']}",
+        "# HELP pywingetupgrader_phase_duration_seconds How long each phase of the last run took.",
+        "# TYPE pywingetupgrader_phase_duration_seconds gauge",
+    ]
+    lines.extend(
+        f'pywingetupgrader_phase_duration_seconds{{phase="{escape_prometheus_label(phase["phase"])}"}} {phase["duration"]}'
+        for phase
+        in summary["phases"]
+    )
+    lines.extend([
+        "# HELP pywingetupgrader_upgrade_duration_seconds How long each upgrade in the last run took.",
+        "# TYPE pywingetupgrader_upgrade_duration_seconds gauge",
+    ])
+    lines.extend(
+        f'pywingetupgrader_upgrade_duration_seconds{{package_id="{escape_prometheus_label(upgrade["id"])}",'
+        f'outcome="{"success" if upgrade["succeeded"] else "failure"}"}} {upgrade["duration"]}'
+        for upgrade
+        in summary["upgrades"]
+    )
+
+    # The collector may read the file at any time, so it's replaced rather than rewritten
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary_path, path)
+
+
+def escape_prometheus_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Kinds of upgrade an application can have, see classify_upgrade()
+UPGRADE_KINDS = ("major", "minor", "patch", "unknown", "unparsed")
+# Kinds of upgrade accepted at each upgrade level, in the order they are upgraded
+UPGRADE_LEVEL_KINDS = {
+    "patch": ("patch",),
+    "minor": ("minor", "patch"),
+    "major": ("major", "minor", "patch"),
+}
+
+
+def classify_upgrade(app):
+    """Return the kind of upgrade available for app, or None if it would not be an upgrade."""
+    current, available = app.parsed_version, app.parsed_available
+    if current is not None and available is not None:
+        return get_upgrade_distance(current, available)
+    if available is not None and app.version.lower() == "unknown":
+        return "unknown"
+    return "unparsed"
+
+
+class UpgradeClassification:
+    """Applications bucketed by the kind of upgrade available, built in a single pass."""
+
+    __slots__ = ("applications", "buckets")
+
+    def __init__(self, applications):
+        self.applications = list(applications)
+        self.buckets = {kind: [] for kind in UPGRADE_KINDS}
+        for app in self.applications:
+            kind = classify_upgrade(app)
+            if kind is not None:
+                self.buckets[kind].append(app)
+
+    def __getitem__(self, kind):
+        return self.buckets[kind]
+
+    def counts(self):
+        return {kind: len(apps) for kind, apps in self.buckets.items()}
+
+    def select(self, upgrade_level, upgrade_unknowns):
+        if upgrade_level.lower() == "all":
+            return list(self.applications)
+
+        apps_to_upgrade = [
+            app
+            for kind
+            in UPGRADE_LEVEL_KINDS.get(upgrade_level.lower(), ())
+            for app
+            in self.buckets[kind]
+        ]
+        if upgrade_unknowns:
+            apps_to_upgrade += self.buckets["unknown"]
+
+        return apps_to_upgrade
+
+
+def get_apps_to_upgrade(applications, upgrade_level, upgrade_unknowns):
+    return UpgradeClassification(applications).select(upgrade_level, upgrade_unknowns)
+
+
+def select_apps_to_upgrade(applications, upgrade_level, upgrade_unknowns, counts=None):
+    """Yield the applications to upgrade one at a time, as they're listed.
+
+    Applications with versions that can be compared are selected by the kind of upgrade
+    available, like UpgradeClassification.select(). Applications in get_allowed_updates()
+    are selected regardless, and ones in get_blocked_updates() never are. counts, when
+    given, is updated with the number of upgrades available of each kind.
+    """
+    allowed_applications = get_allowed_updates()
+    blocked_applications = get_blocked_updates()
+    upgrade_level = upgrade_level.lower()
+    selected_kinds = set(UPGRADE_LEVEL_KINDS.get(upgrade_level, ()))
+    if upgrade_unknowns:
+        selected_kinds.add("unknown")
+
+    for app in applications:
+        comparable = app.parsed_version is not None or app.parsed_available is not None
+        kind = classify_upgrade(app) if comparable else None
+        if counts is not None and kind is not None:
+            counts[kind] = counts.get(kind, 0) + 1
+        if app.id in blocked_applications:
+            continue
+        if app.id in allowed_applications or (comparable and (upgrade_level == "all" or kind in selected_kinds)):
+            yield app
+
+
+def get_allowed_updates():
+    return set([
+        'Python.Python.3'
+        ])
+
+def get_upgrade_priorities():
+    """How much more upgrading each app is worth than others when WINGET_DEADLINE limits
+    what can be upgraded, keyed by id. Apps not listed have a priority of 1."""
+    return {
+        # 'Microsoft.PowerShell': 5,
+    }
+
+def get_security_updates():
+    """Apps whose upgrades are treated as security updates when WINGET_DEADLINE limits what
+    can be upgraded."""
+    return set([
+        'Google.Chrome',
+        'Mozilla.Firefox',
+        'Microsoft.Edge',
+        ])
+
+def get_blocked_updates():
+    return set([
+        'EvanCzaplicki.Elm',
+        'VMware.WorkstationPro',
+        'CoreyButler.NVMforWindows',
+    ])
+
+def get_winget_exe_path(override_path=None, cache_path=None, winapps_dir_path=WINDOWS_APPS_DIR):
+    """Return the path to winget.exe.
+
+    override_path is used as is when given. Otherwise the path found by searching
+    winapps_dir_path is cached at cache_path until the directory is modified or the
+    cached executable disappears.
+    """
+    if override_path:
+        if not os.path.isfile(override_path):
+            raise FileNotFoundError(f"Unable to locate winget executable at '{override_path}'")
+        return override_path
+
+    try:
+        dir_mtime = os.stat(winapps_dir_path).st_mtime
+        if cache_path:
+            cached_exe_path = read_cached_winget_exe_path(cache_path, winapps_dir_path, dir_mtime)
+            if cached_exe_path is not None:
+                return cached_exe_path
+
+        exe_path = find_winget_exe_path(winapps_dir_path)
+
+        if cache_path:
+            write_cached_winget_exe_path(cache_path, winapps_dir_path, dir_mtime, exe_path)
+        return exe_path
+
+    except PermissionError as e:
+        raise e
+
+
+def find_winget_exe_path(winapps_dir_path):
+    """Return winget.exe from the highest installed version of the x64 DesktopAppInstaller."""
+    dir_paths = [
+        dir_ 
+        for dir_ 
+        in os.listdir(winapps_dir_path) 
+        if dir_.startswith('Microsoft.DesktopAppInstaller') and dir_.endswith('x64__8wekyb3d8bbwe')
+    ]
+    if not dir_paths:
+        raise FileNotFoundError("Unable to locate winget executable")
+
+    # Several versions can be installed side by side, e.g.
+    # Microsoft.DesktopAppInstaller_1.21.3482.0_x64__8wekyb3d8bbwe
+    dir_path = max(dir_paths, key=get_windows_app_version)
+    return os.path.join(winapps_dir_path, dir_path, "winget.exe")
+
+
+def get_windows_app_version(dir_name):
+    try:
+        return tuple(int(part) for part in dir_name.split("_")[1].split("."))
+    except (IndexError, ValueError):
+        return ()
+
+
+def read_cached_winget_exe_path(cache_path, winapps_dir_path, dir_mtime):
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        cache.get("windows_apps_dir") != winapps_dir_path
+        or cache.get("dir_mtime") != dir_mtime
+        or not os.path.isfile(cache.get("path", ""))
+    ):
+        return None
+
+    return cache["path"]
+
+
+def write_cached_winget_exe_path(cache_path, winapps_dir_path, dir_mtime, exe_path):
+    try:
+        write_json_atomically(cache_path, {
+            "windows_apps_dir": winapps_dir_path,
+            "dir_mtime": dir_mtime,
+            "path": exe_path,
+        })
+    except OSError as exc:
+        logging.warning(f"Unable to cache winget executable path to '{cache_path}'. {exc}")
+
+
+
+def add_run_options(parser, default=None):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=default if default is not None else False,
+        help="run under cProfile and write the statistics to profile.pstats in the state directory",
+    )
+    parser.add_argument(
+        "--profile-path",
+        default=default,
+        metavar="PATH",
+        help="run under cProfile and write the statistics to PATH",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        type=int,
+        default=default,
+        metavar="N",
+        help="log the N lines allocating the most memory while parsing and filtering the listing",
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Upgrade packages using winget.")
+    add_run_options(parser)
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    plan_parser = commands.add_parser(
+        "plan", help="write the upgrades that would be made to a plan file instead of making them"
+    )
+    apply_parser = commands.add_parser("apply", help="make the upgrades in a plan file without listing upgrades")
+    for command_parser in (plan_parser, apply_parser):
+        command_parser.add_argument(
+            "plan_path",
+            nargs="?",
+            metavar="PATH",
+            help="the plan file, default WINGET_PLAN_PATH or upgrade-plan.json in the state directory",
+        )
+        # Accept the options after the command too, without overwriting ones given before it
+        add_run_options(command_parser, argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    """Run main(), under cProfile or tracing allocations if asked to on the command line or in the environment."""
+    args = parse_args(argv)
+    profile_path = os.environ.get("WINGET_PROFILE_PATH")
+    if args.profile_path:
+        profile_path = args.profile_path
+    elif args.profile:
+        profile_path = os.path.join(get_state_dir(), "profile.pstats")
+    top_allocations = args.trace_allocations
+    if top_allocations is None:
+        top_allocations = get_int_env_var("WINGET_TRACE_ALLOCATIONS", 0)
+
+    allocation_tracer = AllocationTracer(top_allocations) if top_allocations > 0 else None
+    timer = PhaseTimer(allocation_tracer)
+    if profile_path:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, timer, args.command or "run", getattr(args, "plan_path", None))
+        finally:
+            profiler.dump_stats(profile_path)
+            logging.info(f"Wrote profile to '{profile_path}'")
+    else:
+        main(timer, args.command or "run", getattr(args, "plan_path", None))
+
+    if allocation_tracer is not None:
+        allocation_tracer.stop()
+        for line in allocation_tracer.report():
+            logging.info(line)
+
+
+def log_apps_to_upgrade(apps_to_upgrade):
+    logging.debug("[-] Listing apps that would have been upgraded:")
+    for app in apps_to_upgrade:
+        logging.debug(json.dumps(app.to_dict(), indent=2))
+
+
+def main(timer=None, command="run", plan_path=None):
+    """Upgrade apps, or with the "plan" command only write the upgrades that would be made
+    to plan_path, and with the "apply" command make the upgrades planned at plan_path."""
+    start = time.monotonic()
+    history = None
+    winget_exe_path = None
+    if timer is None:
+        timer = PhaseTimer()
+    timings_json_path = timings_prometheus_path = None
+    try:
+        WINGET_DEBUG = get_bool_env_var("WINGET_DEBUG", default=False)
+        upgrade_level = os.environ.get("WINGET_UPGRADE_LEVEL", "patch").lower()
+        upgrade_unknowns = get_bool_env_var("WINGET_UPGRADE_UNKNOWN_VERSIONS", False)
+        max_workers = get_int_env_var("WINGET_MAX_WORKERS", 1)
+        report_path = os.environ.get("WINGET_REPORT_PATH")
+        source = os.environ.get("WINGET_SOURCE")
+        batch_upgrades = get_bool_env_var("WINGET_BATCH_UPGRADES", False)
+        listing_backend = os.environ.get("WINGET_LISTING_BACKEND", "table").lower()
+        use_export = get_bool_env_var("WINGET_USE_EXPORT", False)
+        default_duration = get_int_env_var("WINGET_DEFAULT_UPGRADE_DURATION", 60)
+        deadline_budget = get_float_env_var("WINGET_DEADLINE", 0)
+        default_timeout = get_float_env_var("WINGET_TIMEOUT_DEFAULT", DEFAULT_UPGRADE_TIMEOUT)
+        timeout_headroom = get_float_env_var("WINGET_TIMEOUT_HEADROOM", 1.5)
+        timeout_floor = get_float_env_var("WINGET_TIMEOUT_FLOOR", 60)
+        timeout_ceiling = get_float_env_var("WINGET_TIMEOUT_CEILING", 3600)
+        breaker_threshold = get_int_env_var("WINGET_BREAKER_THRESHOLD", 3)
+        breaker_backoff = get_float_env_var("WINGET_BREAKER_BACKOFF", 24 * 60 * 60)
+        installer_cache_dir = os.environ.get("WINGET_INSTALLER_CACHE_DIR")
+        installer_cache_max_size = get_int_env_var("WINGET_INSTALLER_CACHE_MAX_SIZE", 10 * 1024) * 1024 * 1024
+        # Installers can only be shared when they're downloaded ahead of time
+        prefetch = get_bool_env_var("WINGET_PREFETCH", False) or bool(installer_cache_dir)
+        download_workers = get_int_env_var("WINGET_DOWNLOAD_WORKERS", 4)
+        download_dir = os.environ.get("WINGET_DOWNLOAD_DIR") or os.path.join(get_state_dir(), "downloads")
+        installer_lanes = get_bool_env_var("WINGET_INSTALLER_LANES", True)
+        installer_types_path = os.path.join(get_state_dir(), "installer-types.json")
+        incremental = get_bool_env_var("WINGET_INCREMENTAL", False)
+        snapshot_path = os.environ.get("WINGET_SNAPSHOT_PATH") or os.path.join(get_state_dir(), "listing-snapshot.json")
+        cache_ttl = get_int_env_var("WINGET_CACHE_TTL", 0)
+        cache_path = os.environ.get("WINGET_CACHE_PATH") or os.path.join(get_state_dir(), "upgrade-listing.json")
+        history_path = os.environ.get("WINGET_HISTORY_PATH") or os.path.join(get_state_dir(), "history.sqlite3")
+        timings_json_path = os.environ.get("WINGET_TIMINGS_JSON_PATH")
+        timings_prometheus_path = os.environ.get("WINGET_TIMINGS_PROMETHEUS_PATH")
+        plan_path = plan_path or os.environ.get("WINGET_PLAN_PATH") or os.path.join(get_state_dir(), "upgrade-plan.json")
+
+        
+        log_level = logging.DEBUG if WINGET_DEBUG else logging.INFO
+        logging.basicConfig(level=log_level)
+
+        history = open_history_store(history_path)
+        if history is not None:
+            history.start_run()
+        
+        if get_bool_env_var("WINGET_CACHE_INVALIDATE", False):
+            logging.debug(f"[-] Invalidating listing cache '{cache_path}'")
+            invalidate_listing_cache(cache_path)
+
+        logging.debug("[-] Finding winget executable location...")
+        with timer.phase("exe_discovery"):
+            winget_exe_path = get_winget_exe_path(
+                override_path=os.environ.get("WINGET_EXE_PATH"),
+                cache_path=os.path.join(get_state_dir(), "winget-exe-path.json"),
+            )
+        logging.debug(f"[-] Using winget executable '{winget_exe_path}'")
+
+        stream = False
+        upgrade_counts = {kind: 0 for kind in UPGRADE_KINDS}
+        if command == "apply":
+            logging.debug(f"[-] Reading the upgrade plan '{plan_path}'")
+            plan = read_upgrade_plan(plan_path)
+            apps_to_upgrade, timeouts, installer_types, skipped = plan.apps, plan.timeouts, plan.installer_types, plan.skipped
+            logging.info(
+                f"Applying a plan to upgrade {len(apps_to_upgrade)} apps made "
+                f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(plan.created))}"
+            )
+            if WINGET_DEBUG:
+                log_apps_to_upgrade(apps_to_upgrade)
+                return
+            # Plans made without installer lanes, e.g. for a batch, don't hold installer types
+            if installer_types is None and installer_lanes and max_workers > 1 and not batch_upgrades:
+                with timer.phase("installer_types"):
+                    installer_types = get_installer_types(apps_to_upgrade, winget_exe_path, installer_types_path, max_workers)
+        else:
+            snapshot = None
+            if incremental:
+                logging.debug(f"[-] Reading the last run's listing snapshot '{snapshot_path}'")
+                snapshot = ListingSnapshot.read(
+                    snapshot_path,
+                    get_snapshot_key(winget_exe_path, source, upgrade_level, upgrade_unknowns, listing_backend, use_export),
+                )
+
+            index_db_path = None
+            if listing_backend == "index":
+                index_db_path = os.environ.get("WINGET_INDEX_DB") or find_source_index_path()
+                logging.debug(f"[-] Reading available versions from the winget source index '{index_db_path}'...")
+            else:
+                logging.debug("[-] Calling 'winget upgrade' and parsing results as they arrive...")
+            listing = get_applications_available_to_upgrade(
+                winget_exe_path, source, cache_ttl, cache_path, index_db_path, use_export, snapshot,
+                os.path.join(get_state_dir(), "installed-packages.json"),
+            )
+
+            # Apps are upgraded as they're listed, unless upgrading them needs the whole set
+            # first to plan, order or batch it, or to compare it with the last run's
+            stream = (
+                command == "run"
+                and snapshot is None
+                and deadline_budget <= 0
+                and max_workers <= 1
+                and not batch_upgrades
+                and not prefetch
+                # Allocations are traced per phase, which overlap when streaming
+                and timer.allocation_tracer is None
+            )
+            skipped = []
+            if stream:
+                applications = timer.iter_phase("listing", listing)
+                if history is not None:
+                    applications = history.iter_recording_listing(applications)
+                apps_to_upgrade = select_apps_to_upgrade(applications, upgrade_level, upgrade_unknowns, upgrade_counts)
+                apps_to_upgrade = apply_circuit_breaker(apps_to_upgrade, history, breaker_threshold, breaker_backoff, skipped)
+            else:
+                with timer.phase("listing"):
+                    applications = list(listing)
+                if history is not None:
+                    history.record_listing(applications)
+
+                applications_to_evaluate = applications
+                if snapshot is not None:
+                    applications_to_evaluate = snapshot.get_changed(applications)
+                    logging.debug(
+                        f"[-] {len(applications) - len(applications_to_evaluate)} applications are unchanged since the last run, "
+                        f"evaluating {len(applications_to_evaluate)}"
+                    )
+
+                logging.debug(f"[-] Selecting applications to upgrade based on selected upgrade level: '{upgrade_level}', whether or not unknown applications should be updated: '{upgrade_unknowns}' and the allow and block lists")
+                with timer.phase("selection"):
+                    apps_to_upgrade = list(select_apps_to_upgrade(applications_to_evaluate, upgrade_level, upgrade_unknowns, upgrade_counts))
+                logging.debug(f"[-] Upgrades available by kind: {upgrade_counts}")
+
+                if snapshot is not None and snapshot.listed:
+                    snapshot.update(applications, applications_to_evaluate, apps_to_upgrade)
+                    snapshot.write(snapshot_path)
+                elif snapshot is not None:
+                    logging.warning("Not updating the listing snapshot because listing upgrades failed")
+
+                logging.debug("[-] Skipping apps whose upgrades keep failing")
+                with timer.phase("circuit_breaker"):
+                    apps_to_upgrade = list(apply_circuit_breaker(apps_to_upgrade, history, breaker_threshold, breaker_backoff, skipped))
+
+            if WINGET_DEBUG and command != "plan":
+                log_apps_to_upgrade(apps_to_upgrade)
+                return
+
+            if stream:
+                timeouts = {}
+                apps_to_upgrade = iter_with_upgrade_timeouts(
+                    apps_to_upgrade, timeouts, history, default_timeout, timeout_headroom, timeout_floor, timeout_ceiling
+                )
+                installer_types = None
+            else:
+                if deadline_budget > 0:
+                    remaining_budget = max(deadline_budget - (time.monotonic() - start), 0)
+                    with timer.phase("deadline_selection"):
+                        # Upgrades that run long are what overrun a window, so plan for the slow ones
+                        slow_durations = history.get_duration_percentiles(90) if history is not None else {}
+                        apps_to_upgrade, deferred = select_within_deadline(
+                            apps_to_upgrade,
+                            remaining_budget,
+                            slow_durations,
+                            default_duration,
+                            1 if batch_upgrades else max_workers,
+                        )
+                    logging.info(
+                        f"Upgrading {len(apps_to_upgrade)} apps expected to finish within the remaining "
+                        f"{remaining_budget:.0f}s, deferring {len(deferred)}"
+                    )
+                    skipped = skipped + [
+                        {"id": app.id, "available": app.available, "reason": "deadline"}
+                        for app
+                        in deferred
+                    ]
+
+                if max_workers > 1 and not batch_upgrades and deadline_budget <= 0:
+                    expected_durations = history.get_duration_percentiles(50) if history is not None else {}
+                    apps_to_upgrade = schedule_longest_first(apps_to_upgrade, expected_durations, default_duration)
+                    expected_makespan = estimate_makespan(
+                        [expected_durations.get(app.id, default_duration) for app in apps_to_upgrade],
+                        max_workers,
+                    )
+                    logging.debug(f"[-] Scheduled longest expected upgrades first, expecting to finish in {expected_makespan:.0f}s")
+
+                timeouts = get_upgrade_timeouts(
+                    apps_to_upgrade, history, default_timeout, timeout_headroom, timeout_floor, timeout_ceiling
+                )
+                logging.debug(f"[-] Upgrade timeouts in seconds: {timeouts}")
+
+                installer_types = None
+                # A batch looks up the types of the apps it upgrades individually once it knows them
+                if installer_lanes and max_workers > 1 and not batch_upgrades:
+                    logging.debug("[-] Finding the installer type of each app")
+                    with timer.phase("installer_types"):
+                        installer_types = get_installer_types(
+                            apps_to_upgrade,
+                            winget_exe_path,
+                            installer_types_path,
+                            max_workers,
+                        )
+                    logging.debug(f"[-] Installer types: {installer_types}")
+
+                if command == "plan":
+                    write_upgrade_plan(plan_path, apps_to_upgrade, timeouts, installer_types, skipped)
+                    logging.info(f"Planned upgrades of {len(apps_to_upgrade)} apps to '{plan_path}'")
+                    return
+
+        deadline = start + deadline_budget if deadline_budget > 0 else None
+        if stream:
+            logging.debug("[-] Upgrading apps one at a time as they're listed")
+        else:
+            logging.debug(f"[-] Upgrading {len(apps_to_upgrade)} apps using up to {max_workers} concurrent winget processes")
+        with timer.phase("upgrades"):
+            if batch_upgrades:
+                results = upgrade_apps_in_batch(
+                    apps_to_upgrade, winget_exe_path, max_workers, source, timeouts, deadline,
+                    installer_types, installer_types_path if installer_lanes else None,
+                )
+            elif prefetch:
+                logging.debug(f"[-] Downloading installers to '{download_dir}' using up to {download_workers} concurrent winget processes")
+                results = upgrade_apps_with_prefetch(
+                    apps_to_upgrade, winget_exe_path, download_dir, max_workers, download_workers, timeouts,
+                    installer_types,
+                    InstallerCache(installer_cache_dir, installer_cache_max_size) if installer_cache_dir else None,
+                    deadline,
+                )
+            else:
+                results = upgrade_apps(apps_to_upgrade, winget_exe_path, max_workers, timeouts, installer_types, deadline)
+        if stream:
+            logging.debug(f"[-] Upgrades available by kind: {upgrade_counts}")
+        not_started = []
+        if deadline is not None:
+            started_ids = {result["id"] for result in results}
+            not_started = [app for app in apps_to_upgrade if app.id not in started_ids]
+        if not_started:
+            logging.warning(f"Stopped starting upgrades at the deadline, {len(not_started)} apps weren't upgraded")
+            skipped = skipped + [
+                {"id": app.id, "available": app.available, "reason": "deadline"}
+                for app
+                in not_started
+            ]
+        for result in results:
+            timer.record_upgrade(result)
+            if history is not None:
+                history.record_attempt(result)
+        failure_rates = None
+        if history is not None:
+            try:
+                # Include this run's attempts in the rates
+                history.flush()
+                failure_rates = history.get_failure_rates()
+            except sqlite3.Error as exc:
+                logging.warning(f"Unable to read failure rates from the run history. {exc}")
+        report = build_upgrade_report(results, skipped, failure_rates)
+        if results:
+            # The cached listing no longer reflects what is installed
+            invalidate_listing_cache(cache_path)
+        logging.info(
+            f"Upgraded {report['succeeded']} of {report['attempted']} apps, "
+            f"{report['failed']} failed, {report['skipped']} skipped"
+        )
+        if report_path:
+            write_upgrade_report(report, report_path)
     except PermissionError as e:
         logging.error("Unable to run due to insufficient permissions. Try to rerunning in a system context.")
     except FileNotFoundError as e:
@@ -276,7 +2937,25 @@ def main():
     except Exception as e:
         logging.error(e)
         logging.error(f"Exception thrown in main. {winget_exe_path=}")
+    finally:
+        summary = timer.summary()
+        logging.debug(f"[-] Phase timings: {json.dumps(summary['phases'])}")
+        try:
+            if timings_json_path:
+                write_timings_json(summary, timings_json_path)
+            if timings_prometheus_path:
+                write_timings_prometheus(summary, timings_prometheus_path)
+        except OSError as exc:
+            logging.warning(f"Unable to export phase timings. {exc}")
+        if history is not None:
+            try:
+                for name, duration in timer.phases:
+                    history.record_phase(name, duration)
+                history.finish_run()
+            except sqlite3.Error as exc:
+                logging.warning(f"Unable to record run history. {exc}")
+            history.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run()
\ No newline at end of file